@@ -0,0 +1,165 @@
+"""empty message
+
+Revision ID: a41f07c3e8d2
+Revises: 7c2e9b41d5a3
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+import hashlib
+import json
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+import tiktoken
+import app
+from app.settings import settings
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41f07c3e8d2'
+down_revision = '7c2e9b41d5a3'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+# Generation settings for each prompt type as of this revision.  Old rows don't store them, so they're rebuilt from here.
+# Model None means the row's model, which was always LLM_TYPE.
+TYPE_SETTINGS = {
+    "concept": {"model": settings.LLM_INSTRUCT_TYPE, "temperature": 0.7, "max_tokens": 256},
+    "outline": {"model": settings.LLM_INSTRUCT_TYPE, "temperature": 0.6, "max_tokens": 2048},
+    "topic": {"model": settings.LLM_INSTRUCT_TYPE, "temperature": 0.9, "max_tokens": 512},
+    "title": {"model": None, "temperature": 0.9, "max_tokens": 512},
+    "toc": {"model": None, "temperature": 0.5, "max_tokens": None},
+    "lesson": {"model": None, "temperature": 0.4, "max_tokens": 6000},
+    "rewrite": {"model": None, "temperature": 0.6, "max_tokens": 6000},
+}
+
+
+def prompt_cache_key_v1(prompt, model, temperature, max_tokens, stop_sequences, history, revision):
+    # Frozen copy of app.llm.cache.prompt_cache_key with CACHE_KEY_VERSION 1
+    data = json.dumps(
+        [1, model, temperature, max_tokens, stop_sequences, history, revision, prompt],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(data.encode("utf-8")).digest()
+
+
+def input_section(prompt):
+    return prompt.rsplit("\nInput\n", 1)[-1]
+
+
+def lesson_stop_sequences(prompt):
+    # Lesson chunks stop at the section after this chunk, which is recovered from the table of contents in the prompt
+    text = input_section(prompt)
+    if "Table Of Contents\n" not in text or "Course\n\n" not in text:
+        return None
+    toc = text.split("Table Of Contents\n", 1)[1]
+    for header in ["Research Notes\n", "Next Sections: ", "Course\n\n"]:
+        toc = toc.split(header, 1)[0]
+    outline = [item.strip() for item in toc.strip().split("\n") if item.strip()]
+
+    course = text.split("Course\n\n", 1)[1]
+    current = course.rsplit("---section", 1)[-1].strip().split("\n")[0].strip()
+    if current not in outline:
+        return None
+
+    stop_index = outline.index(current) + settings.SECTIONS_PER_GENERATION
+    if stop_index >= len(outline):
+        return None
+    return [outline[stop_index]]
+
+
+def row_key(tokenizer, prompt, prompt_type, model, version):
+    type_settings = TYPE_SETTINGS.get(prompt_type, {"model": None, "temperature": None, "max_tokens": None})
+    key_model = type_settings["model"] or model
+    max_tokens = type_settings["max_tokens"]
+    stops = None
+
+    if prompt_type == "toc":
+        # generate_tocs sizes the response to the draft table of contents
+        draft_toc = input_section(prompt).split("\nToc: ", 1)[-1]
+        if draft_toc.endswith("\n"):
+            draft_toc = draft_toc[:-1]
+        max_tokens = len(tokenizer.encode(draft_toc)) + 512
+    elif prompt_type == "lesson":
+        stops = lesson_stop_sequences(prompt)
+
+    return prompt_cache_key_v1(prompt, key_model, type_settings["temperature"], max_tokens, stops, None, version), key_model
+
+
+def upgrade() -> None:
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.add_column('prompt', sa.Column('key', sa.LargeBinary(), nullable=True))
+    # ### end Alembic commands ###
+
+    connection = op.get_bind()
+    tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    seen = set()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.text("select id, prompt, type, model, version from prompt where id > :last_id order by id limit :limit"),
+            {"last_id": last_id, "limit": BATCH_SIZE},
+        ).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        duplicates = []
+        for row_id, prompt, prompt_type, model, version in rows:
+            key, key_model = row_key(tokenizer, prompt, prompt_type, model, version)
+            # Rows cached under different LLM_TYPEs can map to the same instruct model
+            if key in seen:
+                duplicates.append(row_id)
+                continue
+            seen.add(key)
+            updates.append({"row_id": row_id, "key": key, "model": key_model})
+
+        if updates:
+            connection.execute(sa.text("update prompt set key = :key, model = :model where id = :row_id"), updates)
+        if duplicates:
+            connection.execute(sa.text("delete from prompt where id = any(:ids)"), {"ids": duplicates})
+        last_id = rows[-1][0]
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.alter_column('prompt', 'key', nullable=False)
+    op.create_index(op.f('ix_prompt_key'), 'prompt', ['key'], unique=True)
+    op.drop_constraint('unique_hash_model_version', 'prompt', type_='unique')
+    op.drop_index('ix_prompt_hash', table_name='prompt')
+    op.drop_column('prompt', 'hash')
+    # ### end Alembic commands ###
+
+
+def downgrade() -> None:
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.add_column('prompt', sa.Column('hash', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+    # ### end Alembic commands ###
+
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.text("select id, prompt from prompt where id > :last_id order by id limit :limit"),
+            {"last_id": last_id, "limit": BATCH_SIZE},
+        ).fetchall()
+        if not rows:
+            break
+        updates = [{"row_id": row_id, "hash": hashlib.sha512(prompt.encode("utf-8")).hexdigest()} for row_id, prompt in rows]
+        connection.execute(sa.text("update prompt set hash = :hash where id = :row_id"), updates)
+        last_id = rows[-1][0]
+
+    # Rows for the same prompt with different settings collapse to one hash, keep the oldest
+    connection.execute(sa.text(
+        "delete from prompt a using prompt b where a.hash = b.hash and a.model = b.model and a.version = b.version and a.id > b.id"
+    ))
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.alter_column('prompt', 'hash', nullable=False)
+    op.create_index('ix_prompt_hash', 'prompt', ['hash'], unique=False)
+    op.create_unique_constraint('unique_hash_model_version', 'prompt', ['hash', 'model', 'version'])
+    op.drop_index(op.f('ix_prompt_key'), table_name='prompt')
+    op.drop_column('prompt', 'key')
+    # ### end Alembic commands ###
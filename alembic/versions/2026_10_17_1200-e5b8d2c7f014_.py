@@ -0,0 +1,77 @@
+"""empty message
+
+Revision ID: e5b8d2c7f014
+Revises: a41f07c3e8d2
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+import app
+from app.db.compression import compress, decompress
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8d2c7f014'
+down_revision = 'a41f07c3e8d2'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+# Table, column, whether the column is json, and whether it's nullable
+COMPRESSED_COLUMNS = [
+    ("prompt", "prompt", False, False),
+    ("prompt", "response", False, False),
+    ("course", "markdown", True, True),
+    ("course", "components", True, True),
+    ("serviceresponse", "response", True, True),
+]
+
+
+def convert_column(table, column, new_type, nullable, convert, select_expr):
+    # Fill a new column in batches, so large tables are never held in memory at once, then swap it in
+    new_column = f"{column}_converted"
+    op.add_column(table, sa.Column(new_column, new_type, nullable=True))
+
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.text(f"select id, {select_expr} from {table} where id > :last_id order by id limit :limit"),
+            {"last_id": last_id, "limit": BATCH_SIZE},
+        ).fetchall()
+        if not rows:
+            break
+        updates = [{"row_id": row_id, "value": convert(value)} for row_id, value in rows if value is not None]
+        if updates:
+            connection.execute(sa.text(f"update {table} set {new_column} = :value where id = :row_id"), updates)
+        last_id = rows[-1][0]
+
+    op.drop_column(table, column)
+    op.alter_column(table, new_column, new_column_name=column, nullable=nullable)
+
+
+def upgrade() -> None:
+    for table, column, is_json, nullable in COMPRESSED_COLUMNS:
+        convert_column(
+            table,
+            column,
+            app.db.compression.CompressedJSON() if is_json else app.db.compression.CompressedText(),
+            nullable,
+            lambda value: compress(value.encode("utf-8")),
+            f"cast({column} as text)",
+        )
+
+
+def downgrade() -> None:
+    for table, column, is_json, nullable in COMPRESSED_COLUMNS:
+        convert_column(
+            table,
+            column,
+            sa.JSON() if is_json else sqlmodel.sql.sqltypes.AutoString(),
+            nullable,
+            lambda value: decompress(value).decode("utf-8"),
+            column,
+        )
@@ -5,6 +5,7 @@ import torch
 from sentence_transformers import util, SentenceTransformer
 
 from app.course.schemas import ResearchNote
+from app.metrics import timer
 
 EMBEDDING_DIM = 384
 
@@ -12,7 +13,8 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
 def create_embeddings(passages, model) -> torch.Tensor:
-    return model.encode(passages, convert_to_tensor=True)
+    with timer("embedding_seconds"):
+        return model.encode(passages, convert_to_tensor=True)
 
 
 def run_query(
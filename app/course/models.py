@@ -1,13 +1,16 @@
 import json
-from typing import List
+from typing import Dict, List
 
 from pydantic import validator
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, tuple_
 from sqlmodel import JSON, Column, Field, select
 
 from app.components.schemas import AllLessonComponentData
 from app.db.base_model import BaseDBModel
+from app.db.compression import CompressedJSON
+from app.db.loader import BatchLoader
 from app.db.session import get_session
+from app.metrics import inc_counter
 from app.course.schemas import ResearchNote
 
 
@@ -18,9 +21,9 @@ class Course(BaseDBModel, table=True):
     topic: str
     outline: List[str] = Field(sa_column=Column(JSON), default=list())
     concepts: List[str] = Field(sa_column=Column(JSON), default=list())
-    markdown: str = Field(sa_column=Column(JSON), default=list())
+    markdown: str = Field(sa_column=Column(CompressedJSON), default=list())
     components: List[AllLessonComponentData] = Field(
-        sa_column=Column(JSON), default=list()
+        sa_column=Column(CompressedJSON), default=list()
     )
     queries: List[str] = Field(sa_column=Column(JSON), default=list())
     context: List[ResearchNote] = Field(sa_column=Column(JSON), default=list())
@@ -35,17 +38,30 @@ class Course(BaseDBModel, table=True):
         return [v.json() for v in val]
 
 
-async def load_cached_course(model: str, topic: str, revision: int):
+async def load_courses(keys: List[tuple[str, str, int]]) -> Dict[tuple[str, str, int], Course]:
     async with get_session() as db:
         query = await db.exec(
-            select(Course).where(Course.topic == topic, Course.model == model, Course.version == revision)
+            select(Course).where(tuple_(Course.model, Course.topic, Course.version).in_(keys))
         )
-        course = query.all()
-    if len(course) == 0:
+        courses = query.all()
+
+    loaded = {}
+    for course in courses:
+        loaded.setdefault((course.model, course.topic, course.version), course)
+    return loaded
+
+
+course_loader = BatchLoader(load_courses)
+
+
+async def load_cached_course(model: str, topic: str, revision: int):
+    course = await course_loader.load((model, topic, revision))
+    inc_counter("cache_lookups_total", table="course", result="hit" if course is not None else "miss")
+    if course is None:
         return None
-    course = course[0]
 
     if course.context is not None:
-        course.context = [ResearchNote(**json.loads(v)) for v in course.context]
+        # The same row can be handed to several callers by the loader, so only parse it once
+        course.context = [ResearchNote(**json.loads(v)) if isinstance(v, str) else v for v in course.context]
 
     return course
@@ -7,6 +7,8 @@ from app.course.schemas import ResearchNote
 from app.llm.exceptions import GenerationError, InvalidRequestError, RateLimitError
 from app.llm.generators.concepts import generate_concepts
 from app.llm.generators.outline import generate_outline
+from app.llm.generators.plan import generate_course_plan
+from app.metrics import timer
 from app.services.generators.pdf import download_and_parse_pdfs, search_pdfs
 from app.services.generators.wiki import search_wiki
 from app.settings import settings
@@ -45,20 +47,43 @@ async def create_course_outline(
     return outline_list, queries
 
 
+async def create_course_plan(course_name: str, outline_items: int, revision: int):
+    """
+    Generate the concepts, outline, and queries for a course with one prompt.
+    """
+    concepts = None
+    outline_list = None
+    queries = None
+    try:
+        plan = await generate_course_plan(course_name, revision, item_count=outline_items, include_examples=settings.INCLUDE_EXAMPLES)
+        if plan.feasible and len(plan.outline) > 0:
+            concepts = plan.concepts
+            outline_list = plan.outline
+            queries = plan.queries
+    except (GenerationError, RateLimitError, InvalidRequestError, RetryError) as e:
+        debug_print_trace()
+        print(f"Error generating plan for {course_name}: {e}")
+
+    return concepts, outline_list, queries
+
+
 async def query_course_context(
     model, queries: List[str], outline_items: List[str], course_name: str
 ) -> List[ResearchNote] | None:
     # Store the pdf data in the database
     # These are general background queries
-    pdf_results = await search_pdfs(queries)
-    pdf_data = await download_and_parse_pdfs(pdf_results)
+    with timer("retrieval_seconds", kind="pdf_search"):
+        pdf_results = await search_pdfs(queries)
+    with timer("retrieval_seconds", kind="pdf_download"):
+        pdf_data = await download_and_parse_pdfs(pdf_results)
 
     # Make queries for each chapter and subsection, but not below that level
     # These are specific queries related closely to the content
     specific_queries = [f"{course_name}: {o}" for o in outline_items if o.count(".") < 3]
     if settings.CUSTOM_SEARCH_SERVER:
         if "wiki" in settings.CUSTOM_SEARCH_TYPES:
-            wiki_results = await search_wiki(specific_queries)
+            with timer("retrieval_seconds", kind="wiki"):
+                wiki_results = await search_wiki(specific_queries)
             pdf_data += wiki_results
 
     # If there are no resources, don't generate research notes
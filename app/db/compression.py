@@ -0,0 +1,70 @@
+import json
+import os
+import zlib
+from functools import lru_cache
+
+from sqlalchemy import LargeBinary, TypeDecorator
+
+from app.settings import settings
+
+DICTIONARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dictionaries")
+
+# The first byte of each value says which dictionary it was compressed with, 0 is none
+# Dictionaries can't change once rows use them, so build a new one under a new id instead
+DICTIONARIES = {
+    1: "v1.zdict",
+}
+CURRENT_DICTIONARY = 1
+
+
+@lru_cache(maxsize=None)
+def load_dictionary(dictionary_id: int) -> bytes:
+    with open(os.path.join(DICTIONARY_DIR, DICTIONARIES[dictionary_id]), "rb") as f:
+        return f.read()
+
+
+def compress(data: bytes, dictionary_id: int = CURRENT_DICTIONARY) -> bytes:
+    if dictionary_id == 0:
+        compressor = zlib.compressobj(settings.DB_COMPRESSION_LEVEL)
+    else:
+        compressor = zlib.compressobj(settings.DB_COMPRESSION_LEVEL, zdict=load_dictionary(dictionary_id))
+    return bytes([dictionary_id]) + compressor.compress(data) + compressor.flush()
+
+
+def decompress(data: bytes) -> bytes:
+    dictionary_id = data[0]
+    if dictionary_id == 0:
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = zlib.decompressobj(zdict=load_dictionary(dictionary_id))
+    return decompressor.decompress(data[1:]) + decompressor.flush()
+
+
+class CompressedText(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = compress(value.encode("utf-8"))
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = decompress(value).decode("utf-8")
+        return value
+
+
+class CompressedJSON(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = compress(json.dumps(value).encode("utf-8"))
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = json.loads(decompress(value))
+        return value
@@ -0,0 +1,53 @@
+import asyncio
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class BatchLoader:
+    """
+    Collects single-key lookups made in the same event loop tick, and resolves them with one batched call.
+    """
+    def __init__(self, batch_fn: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]], max_batch_size: int = 500):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        # Each ray task runs its own event loop, so pending lookups are tracked per loop
+        self.batches = weakref.WeakKeyDictionary()
+        self.tasks = set()
+
+    async def load(self, key: Hashable) -> Any:
+        loop = asyncio.get_running_loop()
+        batch = self.batches.get(loop)
+        if batch is None:
+            batch = {}
+            self.batches[loop] = batch
+            # The dispatch task runs after every coroutine already scheduled in this tick
+            task = loop.create_task(self.dispatch(loop))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        future = batch.get(key)
+        if future is None:
+            future = loop.create_future()
+            batch[key] = future
+        # Callers for the same key share the future, so one of them being cancelled mustn't cancel it for the rest
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys: List[Hashable]) -> List[Any]:
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    async def dispatch(self, loop):
+        batch = self.batches.pop(loop)
+        keys = list(batch.keys())
+        for i in range(0, len(keys), self.max_batch_size):
+            chunk = keys[i:i + self.max_batch_size]
+            try:
+                results = await self.batch_fn(chunk)
+            except Exception as e:
+                for key in chunk:
+                    if not batch[key].done():
+                        batch[key].set_exception(e)
+                continue
+
+            for key in chunk:
+                if not batch[key].done():
+                    batch[key].set_result(results.get(key))
@@ -0,0 +1,38 @@
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+
+from sqlalchemy import text
+
+from app.db.session import async_engine
+from app.settings import settings
+
+
+def advisory_lock_id(key: str) -> int:
+    # Postgres advisory locks are keyed by a signed 64-bit integer
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big", signed=True)
+
+
+@asynccontextmanager
+async def advisory_lock(key: str):
+    """
+    Hold a postgres advisory lock shared by all workers.  The lock is released automatically if the worker dies.
+    Each waiter and holder uses one connection until the lock is released.
+    """
+    lock_id = advisory_lock_id(key)
+    connection = await async_engine.connect()
+    try:
+        # Autocommit, so we don't sit idle in a transaction while the lock is held
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        while True:
+            query = await connection.execute(text("select pg_try_advisory_lock(:id)"), {"id": lock_id})
+            if query.scalar():
+                break
+            await asyncio.sleep(settings.PROMPT_LOCK_POLL_INTERVAL)
+
+        try:
+            yield
+        finally:
+            await connection.execute(text("select pg_advisory_unlock(:id)"), {"id": lock_id})
+    finally:
+        await connection.close()
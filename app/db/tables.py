@@ -1,4 +1,4 @@
 from app.course.models import Course
 from app.db.base_model import BaseDBModel
-from app.llm.models import Prompt
+from app.llm.models import Prompt, PromptTelemetry
 from app.services.models import ScrapedData, ServiceResponse
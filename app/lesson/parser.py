@@ -3,6 +3,7 @@ from typing import List, get_args
 
 from app.components.parser import parse_single_component
 from app.components.schemas import COMPONENT_MAP, AllLessonComponentData, ComponentNames
+from app.llm.stream import StreamParser
 from app.settings import settings
 
 
@@ -29,6 +30,81 @@ def parse_lesson_markdown(markdown: str) -> List[AllLessonComponentData]:
     return parse_component_list(components)
 
 
+class LessonStreamParser(StreamParser):
+    """
+    Parses lesson markdown into components as it streams in, and ends the stream once the stop section header appears.
+    """
+    def __init__(self, stop_section: str | None = None):
+        super().__init__()
+        self.stop_section = stop_section
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.buffer = ""
+        self.current_type = None
+        self.current_lines = []
+        self.components: List[AllLessonComponentData] = []
+        self.done = False
+
+    def feed(self, text: str) -> bool:
+        super().feed(text)
+        if self.done:
+            return True
+
+        # Only the unfinished last line is kept in the buffer
+        lines = (self.buffer + text).split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            if self.process_line(line):
+                return True
+
+        # Catch the stop header before its line is finished
+        if self.reached_stop(self.buffer):
+            self.process_line(self.buffer)
+            self.buffer = ""
+            return True
+        return False
+
+    def reached_stop(self, line: str) -> bool:
+        return self.stop_section is not None and self.stop_section in line
+
+    def process_line(self, line: str) -> bool:
+        if self.reached_stop(line):
+            # Keep anything written before the stop header, like the stop sequence would
+            line = line[:line.index(self.stop_section)]
+            if line.strip():
+                self.current_lines.append(line)
+            self.done = True
+            return True
+
+        if line.startswith("---"):
+            self.finish_component()
+            self.current_type = re.sub("-+", "", line).strip()
+        else:
+            self.current_lines.append(line)
+        return False
+
+    def finish_component(self):
+        if len(self.current_lines) > 0 and self.current_type:
+            markdown = "\n".join(self.current_lines).strip()
+            self.components += parse_component_list([(self.current_type, markdown)])
+        self.current_type = None
+        self.current_lines = []
+
+    def finish(self) -> List[AllLessonComponentData]:
+        if self.buffer:
+            self.current_lines.append(self.buffer)
+            self.buffer = ""
+        self.finish_component()
+
+        components = self.components
+        if len(components) > 1 and components[-1].type == ComponentNames.section:
+            # Remove the final section header, which is the start of the next chunk
+            components = components[:-1]
+        return components
+
+
 def parse_component_list(
     components: List[tuple[str, str]]
 ) -> List[AllLessonComponentData]:
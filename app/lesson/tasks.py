@@ -1,3 +1,4 @@
+import asyncio
 from copy import deepcopy
 from typing import AsyncGenerator, List
 
@@ -8,10 +9,12 @@ from app.components.schemas import (
     ComponentNames,
     MarkdownComponentData,
 )
-from app.lesson.parser import parse_lesson_markdown, render_components_to_markdown
+from app.lesson.parser import LessonStreamParser, render_components_to_markdown
 from app.course.schemas import ResearchNote
 from app.llm.exceptions import GenerationError, InvalidRequestError, RateLimitError
-from app.llm.generators.lesson import generate_lessons
+from app.llm.generators.lesson import PrefixReuse, generate_lessons, lesson_settings
+from app.llm.llm import is_chat_model
+from app.metrics import inc_counter
 from app.settings import settings
 from app.util import debug_print_trace
 
@@ -26,15 +29,118 @@ async def generate_lesson(
 ) -> List[AllLessonComponentData] | None:
     # Add numbers to the outline - needed for generating the lesson
     numbered_outline = outline
+    prefix_reuse = PrefixReuse()
 
+    chapter_starts = get_chapter_starts(numbered_outline)
+    if settings.LESSON_PARALLEL_CHAPTERS and len(chapter_starts) > 1:
+        components = await generate_chapters(
+            course_name,
+            course_components,
+            numbered_outline,
+            revision,
+            chapter_starts,
+            research_notes,
+            sections_per_generation,
+            prefix_reuse,
+        )
+    else:
+        components = await generate_sections(
+            course_name,
+            course_components,
+            numbered_outline,
+            revision,
+            0,
+            len(numbered_outline),
+            research_notes,
+            sections_per_generation,
+            prefix_reuse,
+        )
+
+    if settings.DEBUG:
+        print(f"Prompt prefix reuse for {course_name}: {prefix_reuse.ratio:.0%} of {prefix_reuse.total} characters")
+    return components
+
+
+def get_chapter_starts(outline: List[str]) -> List[int]:
+    # Top level items are numbered like "1. Introduction", subsections like "1.1. Background"
+    chapter_starts = [
+        i for i, item in enumerate(outline)
+        if item.split(" ", 1)[0].strip(".").isdigit()
+    ]
+    if len(chapter_starts) == 0 or chapter_starts[0] != 0:
+        chapter_starts = [0] + chapter_starts
+    return chapter_starts
+
+
+async def generate_chapters(
+    course_name: str,
+    course_components: List[str],
+    outline: List[str],
+    revision: int,
+    chapter_starts: List[int],
+    research_notes: List[ResearchNote] | None,
+    sections_per_generation: int,
+    prefix_reuse: PrefixReuse,
+) -> List[AllLessonComponentData] | None:
+    chapter_ends = chapter_starts[1:] + [len(outline)]
+    # Each chapter is its own sequence of prompts, so interleaved chapters don't count as breaking each other's prefix
+    chapter_reuse = [PrefixReuse() for _ in chapter_starts]
+    chapters = await asyncio.gather(*[
+        generate_sections(
+            course_name,
+            course_components,
+            outline,
+            revision,
+            start,
+            end,
+            research_notes,
+            sections_per_generation,
+            reuse,
+        )
+        for start, end, reuse in zip(chapter_starts, chapter_ends, chapter_reuse)
+    ])
+    for reuse in chapter_reuse:
+        prefix_reuse.merge(reuse)
+    if any(chapter is None for chapter in chapters):
+        return
+
+    components = []
+    lost_priming = 0
+    for chapter in chapters:
+        # Sequentially, each chapter would have been primed with the last section of the chapter before it
+        if len(components) > 0:
+            last_header_index = [
+                i for i, c in enumerate(components) if c.type == ComponentNames.section
+            ][-1]
+            lost_priming += len(render_components_to_markdown(deepcopy(components[last_header_index:])).strip())
+        components += chapter
+
+    inc_counter("lesson_priming_characters_lost_total", lost_priming)
+    if settings.DEBUG:
+        print(f"Generated {len(chapters)} chapters of {course_name} in parallel, without {lost_priming} characters of priming")
+    return components
+
+
+async def generate_sections(
+    course_name: str,
+    course_components: List[str],
+    numbered_outline: List[str],
+    revision: int,
+    start: int,
+    end: int,
+    research_notes: List[ResearchNote] | None,
+    sections_per_generation: int,
+    prefix_reuse: PrefixReuse,
+) -> List[AllLessonComponentData] | None:
+    """
+    Generate the sections of the outline from start up to end, continuing from what was generated before.
+    """
     components = []
-    generated_sections = 0
+    generated_sections = start
     iterations = 0
     use_cache = True
 
-    while generated_sections < len(numbered_outline) and iterations < len(
-        numbered_outline
-    ):
+    while generated_sections < end and iterations < end - start:
         # This is to prime the model with data on what has already been generated
         # The first pass will just include the first section header
         # Subsequent passes will include the previous section and the current section header
@@ -63,14 +169,15 @@ async def generate_lesson(
         current_section = f"{last_section.strip()}\n\n{current_section_header.strip()}"
         current_section = f"{current_section}\n"
 
-        # When to stop generation
+        # When to stop generation, at the latest where this range ends
         stop_section = None
-        if generated_sections + sections_per_generation < len(numbered_outline):
-            stop_section = numbered_outline[generated_sections + sections_per_generation]
+        stop_index = min(generated_sections + sections_per_generation, end)
+        if stop_index < len(numbered_outline):
+            stop_section = numbered_outline[stop_index]
 
         # Filter research notes to save tokens, only keep notes relevant to the next 5 sections
         # Find the indices of the next sections
-        future_sections = set(list(range(generated_sections, len(numbered_outline)))[:sections_per_generation])
+        future_sections = set(list(range(generated_sections, end))[:sections_per_generation])
         selected_research_notes = None
         if research_notes is not None:
             selected_research_notes = []
@@ -91,6 +198,7 @@ async def generate_lesson(
                 include_examples=settings.INCLUDE_EXAMPLES,
                 cache=use_cache,
                 stop_section=stop_section,
+                prefix_reuse=prefix_reuse,
             )
         except (GenerationError, RateLimitError, InvalidRequestError) as e:
             debug_print_trace()
@@ -108,11 +216,11 @@ async def generate_lesson(
             ]
         last_section_index = all_section_headers[-1]
 
-        # Handle partially generated (cut-off) sections
-        # Only do this if there are few components, and it's not the end of the lesson
+        # Handle partially generated (cut-off) sections that weren't continued, like cached responses
+        # Only do this if there are few components, and it's not the end of the range
         if len(components) - last_section_index <= 2 and \
                 len(components[-1].markdown) < 500 and \
-                len(all_section_headers) < len(numbered_outline):
+                len(all_section_headers) < end - start:
             # If we don't have enough components in the last section, it may have been cut off
             components = components[:last_section_index]
             use_cache = False
@@ -120,9 +228,10 @@ async def generate_lesson(
             use_cache = True
 
         iterations += 1
-        generated_sections = len(
+        generated_sections = start + len(
             [c for c in components if c.type == ComponentNames.section]
         )
+
     return components
 
 
@@ -137,37 +246,47 @@ async def generate_single_lesson_chunk(
     include_examples: bool,
     cache: bool,
     stop_section: str | None = None,
+    prefix_reuse: PrefixReuse | None = None,
 ) -> List[AllLessonComponentData]:
-    chunk = await generate_lessons(
-        numbered_outline,
-        current_section,
-        current_section_index,
-        course_name,
-        components,
-        revision,
-        research_notes=research_notes,
-        include_examples=include_examples,
-        cache=cache,
-        stop_section=stop_section,
-    )
-
-    section_start = f"---{ComponentNames.section}"
-
-    # Remove the final section header from the chunk
-    # This happens when we hit the stop token
-    chunk = chunk.strip()
-    # Remove the section header from the chunk
-    if chunk.endswith(section_start):
-        chunk = chunk[:-len(section_start)]
-
-    if stop_section and chunk.endswith(stop_section):
-        chunk = chunk[:-len(stop_section)]
-
-    chunk = chunk.strip()
-
-    new_components = parse_lesson_markdown(chunk)
-    if len(new_components) > 1 and new_components[-1].type == ComponentNames.section:
-        # Remove the final section header from the chunk
-        new_components = new_components[:-1]
-
-    return new_components
+    chunk_components = []
+    prefill = None
+    # Chat models answer the prompt as a new message instead of continuing the prefill, so only completion models continue
+    max_continuations = settings.LESSON_MAX_CONTINUATIONS
+    if is_chat_model(lesson_settings.model or settings.LLM_TYPE):
+        max_continuations = 0
+
+    for i in range(max_continuations + 1):
+        # The parser ends generation once the next chunk's first section starts
+        parser = LessonStreamParser(stop_section)
+        await generate_lessons(
+            numbered_outline,
+            current_section,
+            current_section_index,
+            course_name,
+            components,
+            revision,
+            research_notes=research_notes,
+            include_examples=include_examples,
+            cache=cache,
+            stop_section=stop_section,
+            stream_parser=parser,
+            prefix_reuse=prefix_reuse if prefill is None else None,
+            prefill=prefill,
+        )
+        new_components = parser.finish()
+
+        # Only continue if max_tokens cut the response off, not if it stopped at the next chunk.
+        # Cached responses keep their finish reason, so reruns continue the same way.
+        truncated = parser.finish_reason == "length"
+        if truncated:
+            # The last component was cut off, so drop it, and continue writing after the complete ones
+            new_components = new_components[:-1]
+        chunk_components += new_components
+
+        if not truncated or i == max_continuations or len(new_components) == 0:
+            break
+
+        # The prompt ends with the section header, so the prefill picks up right after it
+        prefill = render_components_to_markdown(deepcopy(chunk_components)).strip() + "\n\n"
+
+    return chunk_components
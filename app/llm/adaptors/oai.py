@@ -1,118 +1,205 @@
+import asyncio
+import json
+import weakref
 from copy import deepcopy
-from typing import AsyncGenerator, List, Optional
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncGenerator, AsyncIterable, Callable, List, Optional
 
-import openai
-import stopit
-import tiktoken
-from aiohttp import ClientPayloadError
-from openai.error import APIConnectionError, APIError, ServiceUnavailableError, Timeout
+import aiohttp
 
+from app.llm.backends import DEFAULT_API_BASE
 from app.llm.exceptions import GenerationError, InvalidRequestError, RateLimitError
-from app.llm.schemas import LLMResponse
 from app.settings import settings
 
-openai.api_key = settings.OPENAI_KEY
-tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
-if settings.OPENAI_BASE_URL:
-    openai.api_base = settings.OPENAI_BASE_URL
+# One pooled session per event loop, since aiohttp sessions can't be shared across loops
+client_sessions = weakref.WeakKeyDictionary()
 
 
 def beginning_of_exception(message: str):
     return message.split(".")[0]
 
 
-def oai_tokenize_prompt(prompt):
-    return len(tokenizer.encode(prompt))
+def get_client_session() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    session = client_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=settings.LLM_POOL_SIZE,
+            keepalive_timeout=settings.LLM_KEEPALIVE_TIMEOUT,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"Authorization": f"Bearer {settings.OPENAI_KEY}"},
+        )
+        client_sessions[loop] = session
+    return session
 
 
-@stopit.threading_timeoutable(default=None)
-async def oai_chat_wrapped(
-    history: List,
-    temperature: float,
-    max_tokens: int,
-    inner_timeout: int = settings.LLM_TIMEOUT,
-    stop_sequences: Optional[List] = None,
-    model: str = settings.LLM_TYPE,
-) -> AsyncGenerator[str, None]:
-    response = await openai.ChatCompletion.acreate(
-        model=model,
-        messages=history,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        n=1,
-        stop=stop_sequences,
-        stream=True,
-        request_timeout=inner_timeout,
-    )
-    async for chunk in response:
-        stream = chunk
-        text = stream["choices"][0]["delta"].get("content", "")
-        if text:
-            yield text  # Streaming API has the delta property, and the content key inside
+async def close_client_session():
+    session = client_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
 
 
-@stopit.threading_timeoutable(default=None)
-async def oai_prompt_wrapped(
-    prompt: str,
-    temperature: float,
-    max_tokens: int,
-    inner_timeout: int = settings.LLM_TIMEOUT,
-    stop_sequences: Optional[List] = None,
-    model: str = settings.LLM_TYPE,
-) -> AsyncGenerator[str, None]:
-    response = await openai.Completion.acreate(
-        model=model,
-        prompt=prompt,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        n=1,
-        stop=stop_sequences,
-        stream=True,
-        request_timeout=inner_timeout,
-    )
-    async for chunk in response:
-        stream = chunk
-        text = stream["choices"][0]["text"]
+def error_message(body: str) -> str:
+    try:
+        return json.loads(body)["error"]["message"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return body
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    # Seconds to wait before retrying, if the provider told us
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(headers["retry-after"])
+                return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+def raise_for_status(status: int, body: str, headers=None):
+    message = beginning_of_exception(error_message(body))
+    if status == 429:
+        raise RateLimitError(message, retry_after=parse_retry_after(headers or {}))
+    if status in (400, 404, 413, 422):
+        raise InvalidRequestError(message)
+    raise GenerationError(f"{status}: {message}")
+
+
+def fast_text_field(data: bytes, field: bytes) -> Optional[bytes]:
+    # Pull a string field out of the event without decoding the json
+    # Returns None if the field isn't a plain string, so the caller can fall back to json
+    start = data.find(field)
+    if start == -1:
+        return None
+    start += len(field)
+    while data[start:start + 1] == b" ":
+        start += 1
+    if data[start:start + 1] != b'"':
+        return None
+    end = data.find(b'"', start + 1)
+    if end == -1:
+        return None
+    value = data[start + 1:end]
+    if b"\\" in value:
+        return None
+    return value
+
+
+def has_finish_reason(data: bytes) -> bool:
+    return b'"finish_reason"' in data and b'"finish_reason":null' not in data and b'"finish_reason": null' not in data
+
+
+async def iter_sse_text(
+    lines: AsyncIterable[bytes],
+    chat: bool,
+    raw: bool = False,
+    on_finish: Optional[Callable[[str], None]] = None,
+) -> AsyncGenerator[str | bytes, None]:
+    """
+    Yield the generated text from a stream of server-sent event lines.  In raw mode, yield utf-8 bytes instead.
+    on_finish is called with the finish reason, like "stop" or "length", when the stream reports one.
+    """
+    field = b'"content":' if chat else b'"text":'
+    async for line in lines:
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+
+        if raw and b'"error"' not in data and not has_finish_reason(data):
+            text = fast_text_field(data, field)
+            if text is not None:
+                if text:
+                    yield text
+                continue
+
+        event = json.loads(data)
+        if "error" in event:
+            raise GenerationError(beginning_of_exception(str(event["error"].get("message", ""))))
+        choices = event.get("choices")
+        if not choices:
+            continue
+
+        # Streaming chat API has the delta property, and the content key inside
+        text = choices[0]["delta"].get("content") if chat else choices[0].get("text")
         if text:
-            yield text  # Streaming API has the delta property, and the content key inside
+            yield text.encode("utf-8") if raw else text
+
+        finish_reason = choices[0].get("finish_reason")
+        if finish_reason and on_finish is not None:
+            on_finish(finish_reason)
+
+
+async def oai_stream(
+    endpoint: str,
+    payload: dict,
+    timeout: int,
+    raw: bool = False,
+    base_url: str = DEFAULT_API_BASE,
+    inactivity_timeout: Optional[int] = None,
+    on_finish: Optional[Callable[[str], None]] = None,
+) -> AsyncGenerator[str | bytes, None]:
+    session = get_client_session()
+    try:
+        # sock_read bounds the gap between reads, so a stalled stream fails long before the total timeout
+        async with session.post(
+            f"{base_url}/{endpoint}",
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=timeout, sock_read=inactivity_timeout),
+        ) as response:
+            if response.status != 200:
+                raise_for_status(response.status, await response.text(), response.headers)
+
+            async for text in iter_sse_text(response.content, endpoint.startswith("chat"), raw, on_finish):
+                yield text
+    except aiohttp.ServerTimeoutError:
+        raise GenerationError(f"Stream stalled for more than {inactivity_timeout} seconds")
+    except asyncio.TimeoutError:
+        raise GenerationError(f"Request timed out after {timeout} seconds")
+    except json.JSONDecodeError as e:
+        raise GenerationError(beginning_of_exception(str(e)))
+    except aiohttp.ClientError as e:
+        raise GenerationError(beginning_of_exception(str(e)))
 
 
-async def oai_prompt_response(
+def oai_prompt_response(
     prompt: str,
     temperature: float = settings.LLM_TEMPERATURE,
     timeout: int = settings.LLM_TIMEOUT,
     max_tokens: int = settings.LLM_MAX_RESPONSE_TOKENS,
     stop_sequences=None,
     model: str = settings.LLM_TYPE,
-) -> Optional[AsyncGenerator[LLMResponse, None]]:
-    response_tokens = 0
-    try:
-        response = oai_prompt_wrapped(
-            prompt,
-            temperature,
-            max_tokens,
-            timeout=timeout,
-            inner_timeout=timeout,
-            stop_sequences=stop_sequences,
-            model=model,
-        )
-        async for chunk in response:
-            response_tokens += 1
-            yield LLMResponse(
-                text=chunk,
-                tokens=response_tokens,
-            )
-    except (ServiceUnavailableError, APIError, Timeout, APIConnectionError) as e:
-        raise GenerationError(beginning_of_exception(str(e)))
-    except openai.error.RateLimitError as e:
-        raise RateLimitError(beginning_of_exception(str(e)))
-    except openai.error.InvalidRequestError as e:
-        raise InvalidRequestError(beginning_of_exception(str(e)))
-    except ClientPayloadError as e:
-        raise GenerationError(beginning_of_exception(str(e)))
-
-
-async def oai_chat_response(
+    raw: bool = False,
+    base_url: str = DEFAULT_API_BASE,
+    inactivity_timeout: Optional[int] = None,
+    on_finish: Optional[Callable[[str], None]] = None,
+) -> AsyncGenerator[str | bytes, None]:
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "n": 1,
+        "stop": stop_sequences,
+        "stream": True,
+    }
+    return oai_stream("completions", payload, timeout, raw, base_url, inactivity_timeout, on_finish)
+
+
+def oai_chat_response(
     prompt: str,
     temperature: float = settings.LLM_TEMPERATURE,
     timeout: int = settings.LLM_TIMEOUT,
@@ -120,7 +207,11 @@ async def oai_chat_response(
     history=None,
     stop_sequences=None,
     model: str = settings.LLM_TYPE,
-) -> Optional[AsyncGenerator[LLMResponse, None]]:
+    raw: bool = False,
+    base_url: str = DEFAULT_API_BASE,
+    inactivity_timeout: Optional[int] = None,
+    on_finish: Optional[Callable[[str], None]] = None,
+) -> AsyncGenerator[str | bytes, None]:
     current_message = {"role": "user", "content": prompt}
     if history is not None:
         history = deepcopy(history)
@@ -128,28 +219,13 @@ async def oai_chat_response(
     else:
         history = [current_message]
 
-    response_tokens = 0
-    try:
-        response = oai_chat_wrapped(
-            history,
-            temperature,
-            max_tokens,
-            timeout=timeout,
-            inner_timeout=timeout,
-            stop_sequences=stop_sequences,
-            model=model,
-        )
-        async for chunk in response:
-            response_tokens += 1
-            yield LLMResponse(
-                text=chunk,
-                tokens=response_tokens,
-            )
-    except (ServiceUnavailableError, APIError, Timeout, APIConnectionError) as e:
-        raise GenerationError(beginning_of_exception(str(e)))
-    except openai.error.RateLimitError as e:
-        raise RateLimitError(beginning_of_exception(str(e)))
-    except openai.error.InvalidRequestError as e:
-        raise InvalidRequestError(beginning_of_exception(str(e)))
-    except ClientPayloadError as e:
-        raise GenerationError(beginning_of_exception(str(e)))
+    payload = {
+        "model": model,
+        "messages": history,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "n": 1,
+        "stop": stop_sequences,
+        "stream": True,
+    }
+    return oai_stream("chat/completions", payload, timeout, raw, base_url, inactivity_timeout, on_finish)
@@ -0,0 +1,147 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from app.llm.exceptions import RateLimitError
+from app.metrics import add_gauge
+from app.settings import settings
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+
+
+class AdaptiveConcurrency:
+    """
+    Additive increase, multiplicative decrease limit on in-flight requests.  The limit shrinks on rate limits or
+    when time to first token climbs well above the best seen, and grows by about one per round trip otherwise.
+    """
+    def __init__(self):
+        self.limit = float(settings.LLM_CONCURRENCY_INITIAL)
+        self.inflight = 0
+        self.waiters = []
+        self.baselines: Dict[str, float] = {}
+        self.last_decrease = 0.0
+
+    async def acquire(self):
+        while self.inflight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # A waiter cancelled after it was woken passes its slot on to the next one
+                if waiter.done() and not waiter.cancelled():
+                    self.wake()
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.inflight += 1
+
+    def release(self):
+        self.inflight -= 1
+        self.wake()
+
+    def wake(self):
+        free = int(self.limit) - self.inflight
+        for waiter in list(self.waiters):
+            if free <= 0:
+                break
+            # Waiters from a finished event loop can't be woken
+            if waiter.done() or waiter.get_loop().is_closed():
+                self.waiters.remove(waiter)
+                continue
+            waiter.set_result(None)
+            free -= 1
+
+    def record_latency(self, prompt_type: str, latency: float):
+        # Latency depends heavily on the prompt, so keep a baseline per prompt type
+        # The baseline drifts up slowly, so one fast outlier doesn't pin it forever
+        baseline = self.baselines.get(prompt_type, latency)
+        baseline = min(latency, baseline + (latency - baseline) * 0.01)
+        self.baselines[prompt_type] = baseline
+
+        if latency > baseline * settings.LLM_CONCURRENCY_LATENCY_TOLERANCE:
+            self.decrease()
+        else:
+            self.limit = min(self.limit + 1 / self.limit, settings.LLM_CONCURRENCY_MAX)
+            self.wake()
+
+    def decrease(self):
+        # Only back off once per cooldown, since in-flight requests will all report the same congestion
+        now = time.monotonic()
+        if now - self.last_decrease < settings.LLM_CONCURRENCY_COOLDOWN:
+            return
+        self.limit = max(self.limit * settings.LLM_CONCURRENCY_BACKOFF, settings.LLM_CONCURRENCY_MIN)
+        self.last_decrease = now
+
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.inflight_tokens = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.concurrency = AdaptiveConcurrency()
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    @asynccontextmanager
+    async def track(self, tokens: int):
+        if settings.LLM_ADAPTIVE_CONCURRENCY:
+            await self.concurrency.acquire()
+        self.inflight_tokens += tokens
+        add_gauge("llm_requests_in_flight", 1, backend=self.url)
+        try:
+            yield self
+        finally:
+            self.inflight_tokens -= tokens
+            add_gauge("llm_requests_in_flight", -1, backend=self.url)
+            if settings.LLM_ADAPTIVE_CONCURRENCY:
+                self.concurrency.release()
+
+    def record_success(self, prompt_type: str, first_token_latency: Optional[float]):
+        self.failures = 0
+        self.ejections = 0
+        if first_token_latency is not None:
+            self.concurrency.record_latency(prompt_type, first_token_latency)
+
+    def record_failure(self, error: Exception):
+        if isinstance(error, RateLimitError):
+            # A busy replica is still healthy, and ejecting it would pile its load onto the others
+            self.concurrency.decrease()
+            return
+
+        self.failures += 1
+        if self.failures >= settings.LLM_BACKEND_MAX_FAILURES:
+            # Back off longer each time a replica fails again right after coming back
+            eject_seconds = settings.LLM_BACKEND_EJECT_SECONDS * 2 ** min(self.ejections, 5)
+            self.ejected_until = time.monotonic() + eject_seconds
+            self.ejections += 1
+            # One more failure after the ejection ends will eject it again
+            self.failures = settings.LLM_BACKEND_MAX_FAILURES - 1
+
+
+class BackendPool:
+    def __init__(self, urls: List[str]):
+        self.backends = [Backend(url) for url in urls]
+
+    def choose(self) -> Backend:
+        now = time.monotonic()
+        healthy = [b for b in self.backends if b.available(now)]
+        if len(healthy) == 0:
+            # Everything is ejected, so try the replica that comes back first
+            return min(self.backends, key=lambda b: b.ejected_until)
+        return min(healthy, key=lambda b: b.inflight_tokens)
+
+
+backend_pools: Dict[str, BackendPool] = {}
+
+
+def get_backend_pool(model: str) -> BackendPool:
+    if model not in backend_pools:
+        urls = settings.LLM_BACKENDS.get(model) or [settings.OPENAI_BASE_URL or DEFAULT_API_BASE]
+        backend_pools[model] = BackendPool(urls)
+    return backend_pools[model]
@@ -0,0 +1,44 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.llm.schemas import GenerationSettings
+from app.llm.tokenizers import count_tokens
+from app.settings import settings
+
+
+def prompt_token_budget(prompt_settings: GenerationSettings, min_response_tokens: Optional[int] = None) -> Optional[int]:
+    model = prompt_settings.model or settings.LLM_TYPE
+    if model not in settings.LLM_TYPES:
+        return None
+
+    response_tokens = min_response_tokens or prompt_settings.min_response_tokens or prompt_settings.max_tokens
+    # The prompt and response have to fit strictly inside the context window
+    return settings.LLM_TYPES[model]["max_tokens"] - response_tokens - 1
+
+
+def fit_prompt(
+    build: Callable[..., str],
+    budget: Optional[int],
+    reductions: Callable[[], List[Tuple[Dict, int]]],
+    model: Optional[str] = None,
+) -> str:
+    """
+    Build the prompt, and if it's over the token budget, apply reductions in order until it fits.  reductions returns dicts
+    of keyword arguments for build, with the tokens each saves on top of the reductions before it, and later reductions keep
+    the earlier ones.  It's only called for prompts over the budget.  The full prompt is only tokenized once, and rebuilt
+    once.  If nothing fits, the smallest prompt is returned, and generation falls back to the extended model.
+    """
+    prompt = build()
+    if budget is None or not settings.LLM_FIT_PROMPTS:
+        return prompt
+
+    tokens = count_tokens(prompt, model)
+    if tokens <= budget:
+        return prompt
+
+    kwargs = {}
+    for reduction, saved_tokens in reductions():
+        kwargs.update(reduction)
+        tokens -= saved_tokens
+        if tokens <= budget:
+            break
+    return build(**kwargs)
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+
+from app.db.loader import BatchLoader
+from app.db.locks import advisory_lock
+from app.db.session import get_session
+from app.llm.models import Prompt
+from app.metrics import inc_counter
+from app.settings import settings
+
+
+class CachedResponse(NamedTuple):
+    response: str
+    finish_reason: Optional[str] = None  # "length" means max_tokens cut the response off
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.items = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: CachedResponse):
+        if key in self.items:
+            self.size -= len(self.items.pop(key).response)
+
+        # Size is measured in characters, which is close enough to bytes for eviction
+        size = len(value.response)
+        if size > self.max_size:
+            return
+
+        self.items[key] = value
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= len(evicted.response)
+
+
+class DiskCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            # WAL mode lets every worker process on the node share the same file
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute("pragma journal_mode=wal")
+            self.connection.execute(
+                "create table if not exists prompt_cache_v2 (key blob primary key, response text not null, finish_reason text)"
+            )
+        return self.connection
+
+    def get(self, key: bytes) -> Optional[CachedResponse]:
+        with self.lock:
+            row = self.connect().execute("select response, finish_reason from prompt_cache_v2 where key = ?", (key,)).fetchone()
+        return CachedResponse(*row) if row else None
+
+    def set(self, key: bytes, value: CachedResponse):
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                "insert or replace into prompt_cache_v2 (key, response, finish_reason) values (?, ?, ?)",
+                (key, value.response, value.finish_reason),
+            )
+            connection.commit()
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time.  Callers that arrive while a call is in flight await its result.
+    """
+    def __init__(self):
+        # Futures are bound to an event loop, and each ray task runs its own loop
+        self.calls = weakref.WeakKeyDictionary()
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable]):
+        loop = asyncio.get_running_loop()
+        calls = self.calls.setdefault(loop, {})
+        while key in calls:
+            future = calls[key]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # If the caller running the call was cancelled rather than this one, run it ourselves
+                if not future.cancelled():
+                    raise
+
+        future = loop.create_future()
+        calls[key] = future
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del calls[key]
+
+
+CACHE_KEY_VERSION = 1
+
+memory_cache = LRUCache(settings.PROMPT_CACHE_SIZE)
+disk_cache = DiskCache(settings.PROMPT_CACHE_PATH) if settings.PROMPT_CACHE_PATH else None
+
+
+async def load_prompt_responses(keys: List[bytes]) -> Dict[bytes, CachedResponse]:
+    async with get_session() as db:
+        # Skip the prompt text, so it isn't read or decompressed
+        query = await db.exec(select(Prompt.key, Prompt.response, Prompt.finish_reason).where(Prompt.key.in_(keys)))
+        rows = query.all()
+    return {key: CachedResponse(response, finish_reason) for key, response, finish_reason in rows}
+
+
+prompt_loader = BatchLoader(load_prompt_responses)
+
+
+def prompt_cache_key(
+    prompt: str,
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    stop_sequences: Optional[List[str]],
+    history: Optional[List],
+    revision: int,
+) -> bytes:
+    # Covers everything sent to the model, so changing any of it misses the cache
+    # Bump CACHE_KEY_VERSION if the key contents change, and add a migration to rekey the prompt table
+    data = json.dumps(
+        [CACHE_KEY_VERSION, model, temperature, max_tokens, stop_sequences, history, revision, prompt],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(data.encode("utf-8")).digest()
+
+
+async def get_cached_response(key: bytes) -> Optional[CachedResponse]:
+    response = memory_cache.get(key)
+    if response is not None:
+        inc_counter("cache_lookups_total", table="prompt", result="memory_hit")
+        return response
+
+    if disk_cache is not None:
+        response = await asyncio.to_thread(disk_cache.get, key)
+        if response is not None:
+            inc_counter("cache_lookups_total", table="prompt", result="disk_hit")
+            memory_cache.set(key, response)
+            return response
+
+    response = await prompt_loader.load(key)
+    inc_counter("cache_lookups_total", table="prompt", result="hit" if response is not None else "miss")
+    if response is None:
+        return None
+
+    memory_cache.set(key, response)
+    if disk_cache is not None:
+        await asyncio.to_thread(disk_cache.set, key, response)
+    return response
+
+
+async def store_cached_response(
+    key: bytes,
+    prompt: str,
+    response: CachedResponse,
+    prompt_type: str,
+    model: str,
+    version: int,
+) -> bool:
+    """
+    Store a response in the database, then in the local caches.  Returns False if the prompt already had a response, which
+    stays the one every cache serves.
+    """
+    async with get_session() as db:
+        try:
+            prompt_model = Prompt(
+                key=key,
+                prompt=prompt,
+                response=response.response,
+                finish_reason=response.finish_reason,
+                type=prompt_type,
+                model=model,
+                version=version,
+            )
+            db.add(prompt_model)
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            return False
+
+    memory_cache.set(key, response)
+    if disk_cache is not None:
+        await asyncio.to_thread(disk_cache.set, key, response)
+    return True
+
+
+prompt_flight = SingleFlight()
+
+
+async def cached_generation(
+    key: bytes,
+    generate: Callable[[], Awaitable[CachedResponse]],
+    prompt: str,
+    prompt_type: str,
+    model: str,
+    version: int,
+) -> Tuple[CachedResponse, bool]:
+    """
+    Returns the response, and whether it came from the cache rather than this call's generation.  Callers that waited on
+    another caller's generation get the same result.
+    """
+    async def locked_generation():
+        if not settings.PROMPT_LOCK_ACROSS_WORKERS:
+            return await store_generation()
+
+        async with advisory_lock(key.hex()):
+            # Another worker may have generated this prompt while we waited for the lock
+            response = await get_cached_response(key)
+            if response is not None:
+                return response, True
+            return await store_generation()
+
+    async def store_generation():
+        response = await generate()
+        if await store_cached_response(key, prompt, response, prompt_type, model, version):
+            return response, False
+
+        # Another worker stored a response first, and that's the one every cache serves
+        stored = await get_cached_response(key)
+        if stored is None:
+            return response, False
+        return stored, True
+
+    return await prompt_flight.run(key, locked_generation)
@@ -0,0 +1,136 @@
+import asyncio
+from collections import OrderedDict
+from copy import deepcopy
+from typing import Callable, Dict, Hashable, List, Optional
+
+import torch
+from sentence_transformers import util
+
+from app.course.embeddings import create_embeddings
+from app.llm.prompts import load_examples, render_single_dict, rendered_examples
+from app.llm.tokenizers import count_tokens
+from app.settings import settings
+
+# The sentence transformer the worker already loaded for research notes.  Until it's set, prompts get every example.
+example_model = None
+
+
+def set_example_model(model):
+    global example_model
+    example_model = model
+
+
+def example_query_text(example: OrderedDict) -> str:
+    # Examples are matched on their inputs, not the outputs they demonstrate
+    inputs = OrderedDict((k, v) for k, v in example.items() if k not in ["json", "markdown"])
+    return render_single_dict(inputs)
+
+
+class ExampleStore:
+    """
+    Embeds each example in a file once, then picks the ones most similar to a prompt that fit a token budget.
+    """
+    def __init__(self, name: str, model):
+        self.name = name
+        self.examples = load_examples(name)
+        self.embeddings = create_embeddings([example_query_text(e) for e in self.examples], model)
+        self.rendered: Dict[Hashable, List[str]] = {}
+
+    def render(self, variant: Hashable, transform: Optional[Callable[[list], list]]) -> List[str]:
+        rendered = self.rendered.get(variant)
+        if rendered is None:
+            examples = deepcopy(self.examples)
+            if transform is not None:
+                examples = transform(examples)
+            rendered = [render_single_dict(e) for e in examples]
+            self.rendered[variant] = rendered
+        return rendered
+
+    def select(
+        self,
+        query_embedding: torch.Tensor,
+        count: int,
+        budget: int,
+        variant: Hashable = None,
+        transform: Optional[Callable[[list], list]] = None,
+        token_model: Optional[str] = None,
+    ) -> str:
+        rendered = self.render(variant, transform)
+        scores = util.cos_sim(query_embedding, self.embeddings)[0]
+
+        selected = []
+        tokens = 0
+        for index in torch.argsort(scores, descending=True).tolist():
+            if len(selected) >= count:
+                break
+            example_tokens = count_tokens(rendered[index], token_model)
+            if tokens + example_tokens > budget:
+                continue
+            selected.append(index)
+            tokens += example_tokens
+
+        # The most similar example goes last, right before the input
+        example_prompt = ""
+        for i, index in enumerate(reversed(selected)):
+            example_prompt += f"Example {i + 1}\n{rendered[index]}\n"
+        return example_prompt
+
+
+example_stores: Dict[str, ExampleStore] = {}
+query_embeddings: OrderedDict = OrderedDict()
+QUERY_EMBEDDING_CACHE_SIZE = 1000
+
+
+def selection_enabled() -> bool:
+    return example_model is not None and settings.EXAMPLE_SELECTION
+
+
+def embed_query(name: str, query: str) -> torch.Tensor:
+    if name not in example_stores:
+        example_stores[name] = ExampleStore(name, example_model)
+
+    embedding = query_embeddings.get(query)
+    if embedding is None:
+        embedding = example_model.encode(query, convert_to_tensor=True)
+        query_embeddings[query] = embedding
+        if len(query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+            query_embeddings.popitem(last=False)
+    else:
+        query_embeddings.move_to_end(query)
+    return embedding
+
+
+async def example_query_embedding(name: str, query: str) -> torch.Tensor | None:
+    """
+    Embed a query for select_examples once per prompt, off the event loop.  None when selection is off.
+    """
+    if not selection_enabled():
+        return None
+    return await asyncio.to_thread(embed_query, name, query)
+
+
+def select_examples(
+    name: str,
+    query_embedding: torch.Tensor | None,
+    count: Optional[int] = None,
+    budget: Optional[int] = None,
+    variant: Hashable = None,
+    transform: Optional[Callable[[list], list]] = None,
+    token_model: Optional[str] = None,
+) -> str:
+    """
+    Render the examples from a file that are most relevant to the query, see example_query_embedding.  Falls back to all
+    of them without a query embedding.
+    """
+    store = example_stores.get(name)
+    if query_embedding is None or store is None:
+        return rendered_examples(name, variant, transform)
+
+    return store.select(
+        query_embedding,
+        count if count is not None else settings.EXAMPLE_COUNT,
+        budget if budget is not None else settings.EXAMPLE_TOKEN_BUDGET,
+        variant,
+        transform,
+        token_model,
+    )
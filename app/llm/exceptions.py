@@ -3,7 +3,9 @@ class GenerationError(Exception):
 
 
 class RateLimitError(Exception):
-    pass
+    def __init__(self, message: str = "", retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 
 class InvalidRequestError(Exception):
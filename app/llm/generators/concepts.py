@@ -1,5 +1,4 @@
 import json
-import os
 from collections import OrderedDict
 from json import JSONDecodeError
 from typing import List
@@ -10,8 +9,10 @@ from tenacity import stop_after_attempt, wait_fixed, before, after, retry, retry
 import threading
 
 from app.llm.exceptions import GenerationError
+from app.llm.example_store import example_query_embedding, select_examples
 from app.llm.llm import GenerationSettings, generate_response
 from app.llm.prompts import build_prompt
+from app.llm.stream import JSONStreamParser
 from app.settings import settings
 from app.util import extract_only_json_dict
 
@@ -28,17 +29,23 @@ concept_settings = GenerationSettings(
     timeout=1200,
     prompt_type="concept",
     model=settings.LLM_INSTRUCT_TYPE,
+    hedge=True,
 )
 
 
-def concept_prompt(topic: str, include_examples=True) -> str:
-    with open(os.path.join(settings.EXAMPLE_JSON_DIR, "concepts.json")) as f:
-        examples = json.load(f)
+def concept_prompt(topic: str, include_examples=True, query_embedding=None) -> str:
+    examples = None
+    if include_examples:
+        examples = select_examples("concepts", query_embedding, token_model=concept_settings.model)
     input = OrderedDict([("topic", topic)])
     prompt = build_prompt("concepts", input, examples, include_examples=include_examples)
     return prompt
 
 
+async def concept_query_embedding(topic: str):
+    return await example_query_embedding("concepts", topic)
+
+
 local_data = threading.local()
 
 
@@ -59,10 +66,12 @@ def after_retry_callback(retry_state):
     reraise=True,
 )
 async def generate_concepts(topic: str, revision: int, include_examples: bool = True) -> CourseGeneratedConcepts:
-    prompt = concept_prompt(topic, include_examples=include_examples)
+    query_embedding = await concept_query_embedding(topic) if include_examples else None
+    prompt = concept_prompt(topic, include_examples=include_examples, query_embedding=query_embedding)
     # If we should cache the prompt - skip cache if we're retrying
     should_cache = not getattr(local_data, "is_retry", False)
-    text = await generate_response(prompt, concept_settings, cache=should_cache, revision=revision)
+    # Stop generating once the json closes
+    text = await generate_response(prompt, concept_settings, cache=should_cache, revision=revision, stream_parser=JSONStreamParser("{"))
     try:
         text = extract_only_json_dict(text)
         text = str(ftfy.fix_text(text))
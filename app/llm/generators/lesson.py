@@ -1,19 +1,25 @@
-import json
 import os
 from collections import OrderedDict
+from functools import partial
 from typing import AsyncGenerator, List, get_args
 
 from app.components.schemas import ComponentNames
 from app.course.schemas import ResearchNote
+from app.llm.budget import fit_prompt, prompt_token_budget
+from app.llm.example_store import example_query_embedding, select_examples
 from app.llm.llm import GenerationSettings, generate_response
 from app.llm.prompts import build_prompt, render_research_notes
+from app.llm.stream import StreamParser
+from app.llm.tokenizers import count_tokens
 from app.settings import settings
 from copy import deepcopy
 
 lesson_settings = GenerationSettings(
     temperature=0.4,
     max_tokens=6000,
+    min_response_tokens=2048,
     timeout=1200,
+    inactivity_timeout=90,
     prompt_type="lesson",
 )
 
@@ -25,6 +31,44 @@ COMPONENT_EXTRAS = {
 }
 
 
+class PrefixReuse:
+    """
+    Tracks how much of each lesson prompt matches the start of the previous prompt for the same book.
+    """
+    def __init__(self):
+        self.last_prompt = None
+        self.reused = 0
+        self.total = 0
+
+    def record(self, prompt: str):
+        if self.last_prompt is not None:
+            self.reused += len(os.path.commonprefix([self.last_prompt, prompt]))
+            self.total += len(prompt)
+        self.last_prompt = prompt
+
+    def merge(self, other: "PrefixReuse"):
+        # Add the counts from another sequence of prompts, like a chapter generated in parallel
+        self.reused += other.reused
+        self.total += other.total
+
+    @property
+    def ratio(self) -> float:
+        if self.total == 0:
+            return 0
+        return self.reused / self.total
+
+
+def filter_example_components(examples: List[dict], components: List[str]) -> List[dict]:
+    for example in examples:
+        blocks = example["markdown"]
+        markdown = ""
+        for block_type, content in blocks:
+            if block_type in components:
+                markdown += f"---{block_type}\n{content}"
+        example["markdown"] = markdown
+    return examples
+
+
 def lesson_prompt(
     outline: List[str],
     current_section: str,
@@ -33,10 +77,55 @@ def lesson_prompt(
     components: List[str],
     include_examples: bool,
     research_notes: List[ResearchNote] | None = None,
+    query_embedding=None,
 ) -> str:
-    with open(os.path.join(settings.EXAMPLE_JSON_DIR, "lesson.json")) as f:
-        examples = json.load(f)
+    def build(**reductions):
+        kwargs = dict(research_notes=research_notes, include_examples=include_examples, query_embedding=query_embedding)
+        kwargs.update(reductions)
+        return render_lesson_prompt(outline, current_section, current_section_index, topic, components, **kwargs)
+
+    def tokens(text: str) -> int:
+        return count_tokens(text, lesson_settings.model)
 
+    # Each reduction comes with the tokens it saves, so the prompt isn't rebuilt and tokenized for every step
+    def reductions():
+        # Notes for sections far from the ones being written are the least useful
+        ranked_notes = []
+        if research_notes:
+            ranked_notes = sorted(
+                research_notes,
+                key=lambda n: min([abs(i - current_section_index) for i in n.outline_items], default=len(outline)),
+            )
+
+        steps = [
+            ({"research_notes": ranked_notes[:i]}, tokens(render_research_notes([ranked_notes[i]])))
+            for i in range(len(ranked_notes) - 1, -1, -1)
+        ]
+
+        # The prefix layout always has the full outline, so the start of the prompt stays the same for every chunk
+        if settings.LESSON_PROMPT_LAYOUT != "prefix":
+            previous_outline = select_outline(outline, current_section_index)
+            for surround in (10, 5, 2, 0):
+                selected_outline = select_outline(outline, current_section_index, surround)
+                saved_tokens = tokens("\n".join(previous_outline)) - tokens("\n".join(selected_outline))
+                steps.append(({"outline_surround": surround}, saved_tokens))
+                previous_outline = selected_outline
+
+        if include_examples:
+            example_components = lesson_components(components)
+            example_tokens = tokens(lesson_examples(example_components, query_embedding))
+            # Without a query embedding every example is used, so there's no count to lower
+            if query_embedding is not None:
+                one_example = tokens(lesson_examples(example_components, query_embedding, 1))
+                steps.append(({"example_count": 1}, example_tokens - one_example))
+                example_tokens = one_example
+            steps.append(({"include_examples": False}, example_tokens))
+        return steps
+
+    return fit_prompt(build, prompt_token_budget(lesson_settings), reductions, lesson_settings.model)
+
+
+def lesson_components(components: List[str]) -> List[str]:
     # Set default components if none are provided
     if not components:
         components = list(get_args(settings.VALID_GENERATED_COMPONENTS))
@@ -50,15 +139,52 @@ def lesson_prompt(
 
     # Basic components that are needed in every lesson
     components += [ComponentNames.text.value, ComponentNames.section.value]
-    components = sorted(list(set(components)))
+    return sorted(list(set(components)))
 
-    for example in examples:
-        blocks = example["markdown"]
-        markdown = ""
-        for block_type, content in blocks:
-            if block_type in components:
-                markdown += f"---{block_type}\n{content}"
-        example["markdown"] = markdown
+
+def lesson_examples(components: List[str], query_embedding=None, example_count: int | None = None) -> str:
+    # Examples are rendered once per component set, then the ones closest to the sections being written are picked
+    return select_examples(
+        "lesson",
+        query_embedding,
+        count=example_count,
+        variant=tuple(components),
+        transform=partial(filter_example_components, components=components),
+        token_model=lesson_settings.model,
+    )
+
+
+def select_outline(outline: List[str], current_section_index: int, outline_surround: int | None = None) -> List[str]:
+    selected_outline = deepcopy(outline)
+    if outline_surround is not None:
+        # Narrowed to fit the token budget, keeping the sections in this chunk and the one after it
+        start_item = max(current_section_index - outline_surround, 0)
+        end_item = min(current_section_index + settings.SECTIONS_PER_GENERATION + 1 + outline_surround, len(outline))
+        selected_outline = selected_outline[start_item:end_item]
+    elif len(outline) > settings.SECTIONS_PER_LESSON and settings.LESSON_PROMPT_LAYOUT != "prefix":
+        surround = min(settings.SECTIONS_PER_LESSON // 2, 10)
+        start_item = max(current_section_index - surround, 0)
+        selected_outline = selected_outline[start_item:]
+    return selected_outline
+
+
+def render_lesson_prompt(
+    outline: List[str],
+    current_section: str,
+    current_section_index: int,
+    topic: str,
+    components: List[str],
+    include_examples: bool,
+    research_notes: List[ResearchNote] | None = None,
+    outline_surround: int | None = None,
+    example_count: int | None = None,
+    query_embedding=None,
+) -> str:
+    components = lesson_components(components)
+
+    examples = None
+    if include_examples:
+        examples = lesson_examples(components, query_embedding, example_count)
 
     # Generate a list of extra sentences to be added in to the prompt that are component specific.
     component_extras = [COMPONENT_EXTRAS.get(c, None) for c in components]
@@ -71,13 +197,11 @@ def lesson_prompt(
     outline_items_to_author_str = ",".join(outline_items_to_author)
     outline_stop_item = outline_items_to_author[-1]
 
-    selected_outline = deepcopy(outline)
-    if len(outline) > settings.SECTIONS_PER_LESSON:
-        surround = min(settings.SECTIONS_PER_LESSON // 2, 10)
-        start_item = max(current_section_index - surround, 0)
-        end_item = min(current_section_index + sections_to_author + surround, len(outline))
-        selected_outline = selected_outline[start_item:end_item]
+    # The prefix layout keeps everything that is the same for each chunk of a book at the start of the prompt,
+    # so backends with prefix caching can reuse it.  The parts that change per chunk go at the end.
+    prefix_layout = settings.LESSON_PROMPT_LAYOUT == "prefix"
 
+    selected_outline = select_outline(outline, current_section_index, outline_surround)
     rendered_outline = "\n".join(selected_outline).strip()
     items = [
         ("Table of contents\n", rendered_outline),
@@ -88,14 +212,16 @@ def lesson_prompt(
         research_content = render_research_notes(research_notes)
         items.append(("research notes\n", research_content))
 
+    section_str = "section" if sections_to_author == 1 else "sections"
+    if prefix_layout:
+        items.append(("next sections", f"Write the next {sections_to_author} {section_str} of the outline, starting from the section below."))
+
     items.append(("course\n\n", current_section))
 
     input = OrderedDict(items)
 
-    section_str = "section" if sections_to_author == 1 else "sections"
-
     prompt = build_prompt(
-        "lesson",
+        "lesson_prefix" if prefix_layout else "lesson",
         input,
         examples,
         include_examples=include_examples,
@@ -123,7 +249,16 @@ async def generate_lessons(
     include_examples: bool = True,
     cache: bool = True,
     stop_section: str | None = None,
+    stream_parser: StreamParser | None = None,
+    prefix_reuse: PrefixReuse | None = None,
+    prefill: str | None = None,
 ) -> str:
+    query_embedding = None
+    if include_examples:
+        # Embedded once for every reduction lesson_prompt tries
+        sections = outline[current_section_index:current_section_index + settings.SECTIONS_PER_GENERATION]
+        query_embedding = await example_query_embedding("lesson", f"{topic}: {', '.join(sections)}")
+
     prompt = lesson_prompt(
         outline,
         current_section,
@@ -132,12 +267,23 @@ async def generate_lessons(
         components,
         include_examples,
         research_notes,
+        query_embedding,
     )
+    if prefix_reuse is not None:
+        prefix_reuse.record(prompt)
 
     stop_sequences = None
     if stop_section is not None:
         stop_sequences = [stop_section]
 
-    text = await generate_response(prompt, lesson_settings, cache=cache, revision=revision, stop_sequences=stop_sequences)
+    text = await generate_response(
+        prompt,
+        lesson_settings,
+        cache=cache,
+        revision=revision,
+        stop_sequences=stop_sequences,
+        stream_parser=stream_parser,
+        prefill=prefill,
+    )
 
     return text
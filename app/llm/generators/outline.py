@@ -1,5 +1,4 @@
 import json
-import os
 import re
 import threading
 from collections import OrderedDict
@@ -11,8 +10,10 @@ from pydantic import BaseModel, parse_obj_as
 from tenacity import retry_if_exception_type, stop_after_attempt, retry, wait_fixed
 
 from app.llm.exceptions import GenerationError
+from app.llm.example_store import example_query_embedding, select_examples
 from app.llm.llm import GenerationSettings, generate_response
 from app.llm.prompts import build_prompt
+from app.llm.stream import JSONStreamParser
 from app.settings import settings
 from app.util import extract_only_json_dict
 
@@ -22,6 +23,7 @@ outline_settings = GenerationSettings(
     timeout=1200,
     prompt_type="outline",
     model=settings.LLM_INSTRUCT_TYPE,
+    hedge=True,
 )
 
 # This can get better results from a finetuned model, forces a certain outline format
@@ -32,9 +34,16 @@ class GeneratedOutlineData(BaseModel):
     queries: List[str] | None = None
 
 
-def outline_prompt(topic: str, concepts: List[str], item_count: int = settings.SECTIONS_PER_LESSON, include_examples=True) -> str:
-    with open(os.path.join(settings.EXAMPLE_JSON_DIR, "outline.json")) as f:
-        examples = json.load(f)
+def outline_prompt(
+    topic: str,
+    concepts: List[str],
+    item_count: int = settings.SECTIONS_PER_LESSON,
+    include_examples=True,
+    query_embedding=None,
+) -> str:
+    examples = None
+    if include_examples:
+        examples = select_examples("outline", query_embedding, token_model=outline_settings.model)
     input = OrderedDict([("topic", topic), ("concepts", concepts)])
     prompt = build_prompt(
         "outline",
@@ -50,6 +59,10 @@ def outline_prompt(topic: str, concepts: List[str], item_count: int = settings.S
     return prompt
 
 
+async def outline_query_embedding(topic: str, concepts: List[str]):
+    return await example_query_embedding("outline", f"{topic}: {', '.join(concepts)}")
+
+
 def parse_json_data(outline: dict) -> GeneratedOutlineData:
     outline = parse_obj_as(GeneratedOutlineData, outline)
     # Get rid of prefix numbers if they exist (they are sometimes added, but we want to strip them out for consistency)
@@ -84,13 +97,16 @@ async def generate_outline(
 ) -> GeneratedOutlineData:
     # Sort concepts alphabetically so that the prompt is the same every time
     concepts = sorted(concepts)
-    prompt = outline_prompt(topic, concepts, item_count=item_count, include_examples=include_examples)
+    query_embedding = await outline_query_embedding(topic, concepts) if include_examples else None
+    prompt = outline_prompt(topic, concepts, item_count=item_count, include_examples=include_examples, query_embedding=query_embedding)
     text = ""
     if settings.FINETUNED:
         text = prompt_start_hint
     # Do not hit cache on retries
     should_cache = not getattr(local_data, "is_retry", False)
-    text += await generate_response(prompt, outline_settings, cache=should_cache, revision=revision)
+    # Stop generating once the json closes.  The hint is already part of it.
+    parser = JSONStreamParser("{", prefix=text)
+    text += await generate_response(prompt, outline_settings, cache=should_cache, revision=revision, stream_parser=parser)
 
     try:
         # Strip out text before/after the json.  Sometimes the LLM will include something before the json input.
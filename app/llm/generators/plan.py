@@ -0,0 +1,127 @@
+import json
+import threading
+from collections import OrderedDict
+from json import JSONDecodeError
+from typing import List
+
+import ftfy
+from pydantic import BaseModel, ValidationError, parse_obj_as
+from tenacity import retry_if_exception_type, stop_after_attempt, retry, wait_fixed
+
+from app.llm.exceptions import GenerationError
+from app.llm.example_store import example_query_embedding, select_examples
+from app.llm.generators.concepts import concept_prompt, concept_query_embedding, concept_settings
+from app.llm.generators.outline import outline_prompt, outline_query_embedding, outline_settings, prompt_start_hint
+from app.llm.llm import GenerationSettings, generate_response, store_response
+from app.llm.schemas import GenerationStats
+from app.llm.prompts import build_prompt
+from app.llm.stream import JSONStreamParser
+from app.settings import settings
+from app.util import extract_only_json_dict
+
+plan_settings = GenerationSettings(
+    temperature=0.6,
+    max_tokens=2304,
+    timeout=1200,
+    prompt_type="plan",
+    model=settings.LLM_INSTRUCT_TYPE,
+    hedge=True,
+)
+
+
+class GeneratedCoursePlan(BaseModel):
+    feasible: bool
+    concepts: List[str]
+    outline: List[str]
+    queries: List[str] | None = None
+
+
+def plan_prompt(topic: str, item_count: int = settings.SECTIONS_PER_LESSON, include_examples=True, query_embedding=None) -> str:
+    examples = None
+    if include_examples:
+        examples = select_examples("plan", query_embedding, token_model=plan_settings.model)
+    input = OrderedDict([("topic", topic)])
+    prompt = build_prompt(
+        "plan",
+        input,
+        examples,
+        topic=topic,
+        item_count=item_count,
+        include_examples=include_examples,
+    )
+    return prompt
+
+
+async def store_plan_parts(topic: str, plan: GeneratedCoursePlan, revision: int, item_count: int, include_examples: bool):
+    # Cache the plan as if the concepts and outline prompts had answered it, so either mode reuses it
+    concepts = {"feasible": plan.feasible, "concepts": plan.concepts}
+    query_embedding = await concept_query_embedding(topic) if include_examples else None
+    prompt = concept_prompt(topic, include_examples=include_examples, query_embedding=query_embedding)
+    await store_response(prompt, concept_settings, json.dumps(concepts), revision)
+
+    if not plan.feasible:
+        return
+
+    # Concepts are sorted the same way generate_outline sorts them
+    concepts = sorted(plan.concepts)
+    query_embedding = await outline_query_embedding(topic, concepts) if include_examples else None
+    prompt = outline_prompt(topic, concepts, item_count=item_count, include_examples=include_examples, query_embedding=query_embedding)
+    outline = json.dumps({"outline": plan.outline, "queries": plan.queries or []})
+    if settings.FINETUNED:
+        # The outline prompt ends with the start of the response, which isn't cached
+        response_start = prompt_start_hint.lstrip("\n")
+        if not outline.startswith(response_start):
+            return
+        outline = outline[len(response_start):]
+    await store_response(prompt, outline_settings, outline, revision)
+
+
+local_data = threading.local()
+
+
+def before_retry_callback(retry_state):
+    local_data.is_retry = True
+
+
+def after_retry_callback(retry_state):
+    local_data.is_retry = False
+
+
+@retry(
+    retry=retry_if_exception_type(GenerationError),
+    stop=stop_after_attempt(5),
+    wait=wait_fixed(2),
+    before_sleep=before_retry_callback,
+    after=after_retry_callback,
+    reraise=True,
+)
+async def generate_course_plan(
+    topic: str,
+    revision: int,
+    item_count: int = 10,
+    include_examples: bool = True
+) -> GeneratedCoursePlan:
+    """
+    Generate the concepts, outline, and queries for a course in one call, instead of separate concepts and outline calls.
+    """
+    query_embedding = await example_query_embedding("plan", topic) if include_examples else None
+    prompt = plan_prompt(topic, item_count=item_count, include_examples=include_examples, query_embedding=query_embedding)
+    # Do not hit cache on retries
+    should_cache = not getattr(local_data, "is_retry", False)
+    stats = GenerationStats()
+    text = await generate_response(
+        prompt, plan_settings, cache=should_cache, revision=revision, stream_parser=JSONStreamParser("{"), stats=stats
+    )
+
+    try:
+        text = extract_only_json_dict(text)
+        text = str(ftfy.fix_text(text))
+        data = json.loads(text.strip())
+        plan = parse_obj_as(GeneratedCoursePlan, data)
+    except (JSONDecodeError, ValidationError) as e:
+        raise GenerationError(e)
+
+    # A cached plan was already stored when it was generated
+    if not stats.cache_hit:
+        await store_plan_parts(topic, plan, revision, item_count, include_examples)
+    return plan
@@ -1,29 +1,61 @@
-import json
-import os
 from collections import OrderedDict
 from typing import AsyncGenerator, List, get_args
 
 from app.course.schemas import ResearchNote
+from app.llm.budget import fit_prompt, prompt_token_budget
 from app.llm.llm import GenerationSettings, generate_response
-from app.llm.prompts import build_prompt, render_research_notes
+from app.llm.prompts import build_prompt, render_research_notes, rendered_examples
+from app.llm.tokenizers import count_tokens
 from app.settings import settings
 
 rewrite_settings = GenerationSettings(
     temperature=.6,
     max_tokens=6000,
+    min_response_tokens=2048,
     timeout=1200,
+    inactivity_timeout=90,
     prompt_type="rewrite"
 )
 
 
+def draft_rewrite_settings(draft: str) -> GenerationSettings:
+    # The rewrite is about as long as the draft, so leave room for at least that much
+    min_response_tokens = max(rewrite_settings.min_response_tokens, count_tokens(draft, rewrite_settings.model, memoize=False))
+    return rewrite_settings.copy(update={"min_response_tokens": min(min_response_tokens, rewrite_settings.max_tokens)})
+
+
 def rewrite_prompt(
     topic: str,
     draft: str,
     include_examples: bool,
     research_notes: List[ResearchNote] | None = None,
 ) -> str:
-    with open(os.path.join(settings.EXAMPLE_JSON_DIR, "rewrite.json")) as f:
-        examples = json.load(f)
+    def build(**reductions):
+        kwargs = dict(research_notes=research_notes, include_examples=include_examples)
+        kwargs.update(reductions)
+        return render_rewrite_prompt(topic, draft, **kwargs)
+
+    # Notes are dropped from the end, then the examples
+    def reductions():
+        notes = research_notes or []
+        steps = [
+            ({"research_notes": notes[:i]}, count_tokens(render_research_notes([notes[i]]), rewrite_settings.model))
+            for i in range(len(notes) - 1, -1, -1)
+        ]
+        if include_examples:
+            steps.append(({"include_examples": False}, count_tokens(rendered_examples("rewrite"), rewrite_settings.model)))
+        return steps
+
+    return fit_prompt(build, prompt_token_budget(draft_rewrite_settings(draft)), reductions, rewrite_settings.model)
+
+
+def render_rewrite_prompt(
+    topic: str,
+    draft: str,
+    include_examples: bool,
+    research_notes: List[ResearchNote] | None = None,
+) -> str:
+    examples = rendered_examples("rewrite")
 
     items = [("topic", topic)]
 
@@ -62,6 +94,6 @@ async def generate_rewrite(
         research_notes,
     )
 
-    text = await generate_response(prompt, rewrite_settings, cache=cache, revision=revision)
+    text = await generate_response(prompt, draft_rewrite_settings(draft), cache=cache, revision=revision)
 
     return text
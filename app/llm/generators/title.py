@@ -1,12 +1,12 @@
 import json
-import os
 from collections import OrderedDict
 from json import JSONDecodeError
 from typing import List
 
 from app.llm.exceptions import GenerationError
 from app.llm.llm import GenerationSettings, generate_response
-from app.llm.prompts import build_prompt
+from app.llm.prompts import build_prompt, rendered_examples
+from app.llm.stream import JSONStreamParser
 from app.settings import settings
 from app.util import extract_only_json_list
 
@@ -14,13 +14,13 @@ title_settings = GenerationSettings(
     temperature=0.9,
     max_tokens=512,
     timeout=40,
-    prompt_type="title"
+    prompt_type="title",
+    hedge=True,
 )
 
 
 def title_prompt(subject: str) -> str:
-    with open(os.path.join(settings.EXAMPLE_JSON_DIR, f"title.json")) as f:
-        examples = json.load(f)
+    examples = rendered_examples("title")
     input = OrderedDict([("subject", subject)])
     prompt = build_prompt("title", input, examples)
     return prompt
@@ -30,7 +30,7 @@ async def generate_title(
     subject: str,
 ) -> List[str]:
     prompt = title_prompt(subject)
-    text = await generate_response(prompt, title_settings, cache=False)
+    text = await generate_response(prompt, title_settings, cache=False, stream_parser=JSONStreamParser("["))
 
     try:
         text = extract_only_json_list(text)
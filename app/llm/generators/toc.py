@@ -1,5 +1,4 @@
 import json
-import os
 from collections import OrderedDict
 from copy import deepcopy
 from json import JSONDecodeError
@@ -10,10 +9,11 @@ from pydantic import BaseModel
 
 from app.llm.exceptions import GenerationError
 from app.llm.llm import GenerationSettings, generate_response
-from app.llm.prompts import build_prompt
+from app.llm.prompts import build_prompt, rendered_examples
+from app.llm.stream import JSONStreamParser
 from app.settings import settings
 from app.util import extract_only_json_dict
-from app.llm.adaptors.oai import oai_tokenize_prompt
+from app.llm.tokenizers import count_tokens
 
 
 class GeneratedTOC(BaseModel):
@@ -32,8 +32,7 @@ toc_settings = GenerationSettings(
 
 
 def toc_prompt(topic: str, toc: str, include_examples=True) -> str:
-    with open(os.path.join(settings.EXAMPLE_JSON_DIR, "toc.json")) as f:
-        examples = json.load(f)
+    examples = rendered_examples("toc")
     input = OrderedDict([
         ("topic", topic),
         ("toc", toc),
@@ -47,11 +46,11 @@ async def generate_tocs(topic: str, draft_toc: str, include_examples: bool = Tru
 
     settings_inst = deepcopy(toc_settings)
     try:
-        settings_inst.max_tokens = oai_tokenize_prompt(draft_toc) + 512 # Max tokens to generate
+        settings_inst.max_tokens = count_tokens(draft_toc, toc_settings.model, memoize=False) + 512 # Max tokens to generate
     except Exception:
         return
 
-    text = await generate_response(prompt, settings_inst)
+    text = await generate_response(prompt, settings_inst, stream_parser=JSONStreamParser("{"))
     try:
         text = extract_only_json_dict(text)
         text = str(ftfy.fix_text(text))
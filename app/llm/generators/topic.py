@@ -1,12 +1,12 @@
 import json
-import os
 from collections import OrderedDict
 from json import JSONDecodeError
 from typing import List, Optional
 
 from app.llm.exceptions import GenerationError
 from app.llm.llm import GenerationSettings, generate_response
-from app.llm.prompts import build_prompt
+from app.llm.prompts import build_prompt, rendered_examples
+from app.llm.stream import JSONStreamParser
 from app.settings import settings
 from app.util import extract_only_json_list
 
@@ -16,12 +16,12 @@ topic_settings = GenerationSettings(
     timeout=40,
     prompt_type="topic",
     model=settings.LLM_INSTRUCT_TYPE,
+    hedge=True,
 )
 
 
 def topic_prompt(book_title: str) -> str:
-    with open(os.path.join(settings.EXAMPLE_JSON_DIR, f"topic.json")) as f:
-        examples = json.load(f)
+    examples = rendered_examples("topic")
     input = OrderedDict([("title", book_title)])
     prompt = build_prompt("topic", input, examples, title=book_title)
     return prompt
@@ -31,7 +31,7 @@ async def generate_topic(
     book_title: str,
 ) -> List[str]:
     prompt = topic_prompt(book_title)
-    text = await generate_response(prompt, topic_settings)
+    text = await generate_response(prompt, topic_settings, stream_parser=JSONStreamParser("["))
     try:
         text = extract_only_json_list(text)
         data = json.loads(text.strip())
@@ -41,8 +41,7 @@ async def generate_topic(
 
 
 def topic_specific_prompt(book_title: str, domain: Optional[str]) -> str:
-    with open(os.path.join(settings.EXAMPLE_JSON_DIR, f"specific_topic.json")) as f:
-        examples = json.load(f)
+    examples = rendered_examples("specific_topic")
     input = OrderedDict([("title", book_title)])
     prompt = build_prompt(
         "specific_topic", input, examples, title=book_title, domain=domain
@@ -55,7 +54,7 @@ async def generate_specific_topic(
     domain: Optional[str] = None,
 ) -> List[str]:
     prompt = topic_specific_prompt(book_title, domain)
-    text = await generate_response(prompt, topic_settings)
+    text = await generate_response(prompt, topic_settings, stream_parser=JSONStreamParser("["))
 
     try:
         text = extract_only_json_list(text)
@@ -1,24 +1,70 @@
 import asyncio
-import hashlib
+import random
 import time
-from typing import AsyncGenerator, List, Optional
+from collections import defaultdict, deque
+from copy import deepcopy
+from typing import AsyncGenerator, Callable, List, Optional
 
-from sqlalchemy.exc import IntegrityError
-from sqlmodel import select
-
-from app.db.session import get_session
-from app.llm.adaptors.oai import (
-    oai_chat_response,
-    oai_prompt_response,
-    oai_tokenize_prompt,
-)
+from app.llm.adaptors.oai import oai_chat_response, oai_prompt_response
+from app.llm.backends import get_backend_pool
+from app.llm.cache import CachedResponse, cached_generation, get_cached_response, prompt_cache_key, store_cached_response
 from app.llm.exceptions import GenerationError, InvalidRequestError, RateLimitError
-from app.llm.models import Prompt
-from app.llm.schemas import GenerationSettings
+from app.llm.rate_limit import wait_for_capacity
+from app.llm.schemas import GenerationSettings, GenerationStats
+from app.llm.stream import StreamParser
+from app.llm.telemetry import record_telemetry
+from app.llm.tokenizers import count_tokens
+from app.metrics import inc_counter, observe
 from app.settings import settings
 from app.util import fix_unicode_text
 
 
+def is_chat_model(model: str) -> bool:
+    # The models run_generation sends to the chat endpoint
+    return model in ["gpt-3.5-turbo", "gpt-4"]
+
+
+def merge_stop_sequences(prompt_settings: GenerationSettings, stop_sequences: Optional[List[str]]) -> Optional[List[str]]:
+    # Stop sequences for the llm
+    stops = []
+    if prompt_settings.stop_sequences is not None:
+        stops.extend(prompt_settings.stop_sequences)
+    if stop_sequences is not None:
+        stops.extend(stop_sequences)
+
+    # Only support up to 4 stop sequences
+    if len(stops) == 0:
+        return None
+    return stops[:4]
+
+
+async def store_response(
+    prompt: str,
+    prompt_settings: GenerationSettings,
+    response: str,
+    revision: int = 1,
+    stop_sequences: Optional[List[str]] = None,
+):
+    """
+    Cache a response for a prompt that was answered some other way, so generate_response returns it without calling the llm.
+    Prompts that already have a response keep it.
+    """
+    prompt = fix_unicode_text(prompt)
+    model = prompt_settings.model or settings.LLM_TYPE
+    key = prompt_cache_key(
+        prompt,
+        model,
+        prompt_settings.temperature,
+        prompt_settings.max_tokens,
+        merge_stop_sequences(prompt_settings, stop_sequences),
+        None,
+        revision,
+    )
+    if await get_cached_response(key) is not None:
+        return
+    await store_cached_response(key, prompt, CachedResponse(response), prompt_settings.prompt_type, model, revision)
+
+
 async def generate_response(
     prompt: str,
     prompt_settings: GenerationSettings,
@@ -27,69 +73,193 @@ async def generate_response(
     cache: bool = True,
     revision: int = 1,
     stop_sequences: Optional[List[str]] = None,
+    stream_parser: Optional[StreamParser] = None,
+    prefill: Optional[str] = None,
+    stats: Optional[GenerationStats] = None,
 ) -> str:
-    temperature = prompt_settings.temperature
-    max_tokens = prompt_settings.max_tokens
-    timeout = prompt_settings.timeout
-    prompt_stops = prompt_settings.stop_sequences
+    # Pass stats to see how the response was produced, like whether it came from the cache
+    started = time.monotonic()
     prompt_type = prompt_settings.prompt_type
-    model = (
-        prompt_settings.model or settings.LLM_TYPE
-    )  # Use default model if not specified
+    stops = merge_stop_sequences(prompt_settings, stop_sequences)
 
-    # Stop sequences for the llm
-    stops = []
-    if prompt_stops is not None:
-        stops.extend(prompt_stops)
-    if stop_sequences is not None:
-        stops.extend(stop_sequences)
-
-    # Only support up to 4 stop sequences
-    if len(stops) == 0:
-        stops = None
-    else:
-        stops = stops[:4]
+    # Continue from partial output.  This works for prompts that end where the response starts, like lessons, and only
+    # with completion models.  Chat models treat the prompt as a finished message, see is_chat_model.
+    # The prefill is part of the prompt, so it gets its own cache key, and only the new text is returned.
+    if prefill:
+        prompt += prefill
 
     # Remove utf-8 surrogate characters
     prompt = fix_unicode_text(prompt)
 
-    # Hash the prompt as a DB key
-    hash = hashlib.sha512()
-    hash.update(prompt.encode("utf-8"))
-    hex = hash.hexdigest()
+    # Key the cache on everything that affects the response
+    model = prompt_settings.model or settings.LLM_TYPE
+    key = prompt_cache_key(
+        prompt,
+        model,
+        prompt_settings.temperature,
+        prompt_settings.max_tokens,
+        stops,
+        history,
+        revision,
+    )
 
-    async with get_session() as db:
-        # Break if we've already run this prompt
-        query = await db.exec(
-            select(Prompt).where(Prompt.hash == hex, Prompt.model == settings.LLM_TYPE, Prompt.version == revision)
-        )
-        prompt_model = query.first()
+    if stream_parser is not None:
+        stream_parser.reset()
+
+    # Generation fields stay empty if the response comes from the cache
+    if stats is None:
+        stats = GenerationStats()
+    if prompt_settings.hedge and settings.LLM_HEDGE_REQUESTS:
+        generate = lambda: run_hedged_generation(prompt, prompt_settings, stops, history, max_tries, stats, stream_parser)
+    else:
+        generate = lambda: run_generation(prompt, prompt_settings, stops, history, max_tries, stream_parser, stats=stats)
+
+    async def generate_with_reason():
+        text = await generate()
+        return CachedResponse(text, stats.finish_reason)
+
+    try:
+        if not cache:
+            # Skip caching
+            cached = await generate_with_reason()
+        else:
+            # Break if we've already run this prompt
+            cached = await get_cached_response(key)
+            stats.cache_hit = cached is not None
+            if cached is None:
+                # Concurrent callers with the same prompt wait for a single generation
+                cached, stats.cache_hit = await cached_generation(
+                    key,
+                    generate_with_reason,
+                    prompt,
+                    prompt_type,
+                    model,
+                    revision,
+                )
+    except Exception as e:
+        stats.error = type(e).__name__
+        raise
+    finally:
+        # Failed calls are recorded too
+        latency = time.monotonic() - started
+        record_telemetry(key.hex(), prompt_type, model, revision, latency, stats)
+        inc_counter("llm_calls_total", prompt_type=prompt_type, model=stats.model or model, cache_hit=stats.cache_hit)
+        observe("llm_call_seconds", latency, prompt_type=prompt_type)
+
+    text = cached.response
+
+    # Cached and deduplicated responses never stream through the parser, and a response another worker stored first
+    # replaces the one that did
+    if stream_parser is not None and (stream_parser.received == 0 or stats.cache_hit):
+        stream_parser.reset()
+        stream_parser.feed(text)
+        stream_parser.finish_reason = cached.finish_reason
+    return text
 
-    if prompt_model is not None and cache:
-        return prompt_model.response
 
-    orig_model = model
+async def run_generation(
+    prompt: str,
+    prompt_settings: GenerationSettings,
+    stops: Optional[List[str]],
+    history: Optional[List] = None,
+    max_tries: int = 2,
+    stream_parser: Optional[StreamParser] = None,
+    on_first_token: Optional[Callable[[], None]] = None,
+    stats: Optional[GenerationStats] = None,
+) -> str:
+    temperature = prompt_settings.temperature
+    timeout = prompt_settings.timeout
+    inactivity_timeout = prompt_settings.inactivity_timeout or settings.LLM_INACTIVITY_TIMEOUT
+    orig_model = (
+        prompt_settings.model or settings.LLM_TYPE
+    )  # Use default model if not specified
+
     for i in range(max_tries):
-        try:
-            match model:
-                case "gpt-3.5-turbo" | "gpt-4":
-                    prompt_tokens = oai_tokenize_prompt(prompt)
+        model = orig_model
+        max_tokens = prompt_settings.max_tokens
+        backend = None
+        # Sizing the request and waiting for rate limit capacity happen outside the retries, since they aren't generation failures
+        match model:
+            case "gpt-3.5-turbo" | "gpt-4":
+                chat = True
+                prompt_tokens = count_tokens(prompt, model)
 
-                    # Reduce tokens requested if we have too many in the prompt
+                # Reduce tokens requested if we have too many in the prompt
+                allowed_tokens = settings.LLM_TYPES[model]["max_tokens"] - prompt_tokens - 1
+                min_response_tokens = prompt_settings.min_response_tokens or max_tokens
+                if settings.LLM_FIT_PROMPTS and max_tokens > allowed_tokens >= min_response_tokens:
+                    max_tokens = allowed_tokens
+
+                if (
+                    prompt_tokens + max_tokens
+                    >= settings.LLM_TYPES[model]["max_tokens"]
+                ):
+                    # Use extended model if we have too many tokens
+                    model = settings.LLM_EXTENDED_TYPE
                     if (
                         prompt_tokens + max_tokens
                         >= settings.LLM_TYPES[model]["max_tokens"]
                     ):
-                        # Use extended model if we have too many tokens
-                        model = settings.LLM_EXTENDED_TYPE
-                        if (
-                            prompt_tokens + max_tokens
-                            >= settings.LLM_TYPES[model]["max_tokens"]
-                        ):
-                            raise InvalidRequestError(
-                                f"Input prompt is too long, requested {prompt_tokens} prompt tokens and {max_tokens} generation tokens."
-                            )
+                        raise InvalidRequestError(
+                            f"Input prompt is too long, requested {prompt_tokens} prompt tokens and {max_tokens} generation tokens."
+                        )
+            case "gpt-3.5-turbo-instruct":
+                chat = False
+                prompt_tokens = count_tokens(prompt, model)
+                if (
+                    prompt_tokens + max_tokens
+                    >= settings.LLM_TYPES[model]["max_tokens"]
+                ):
+                    raise InvalidRequestError(
+                        f"Input prompt is too long, requested {prompt_tokens} prompt tokens and {max_tokens} generation tokens."
+                    )
+            case _:
+                if model not in settings.LLM_TYPES:
+                    raise NotImplementedError(
+                        "This LLM type is not supported currently."
+                    )
+
+                chat = False
+                prompt_tokens = count_tokens(prompt, model)
+
+                allowed_tokens = settings.LLM_TYPES[model]["max_tokens"]
+                if prompt_tokens + max_tokens > allowed_tokens:
+                    max_tokens = allowed_tokens - prompt_tokens
+
+                if max_tokens < 256:
+                    raise InvalidRequestError(
+                        f"Input prompt is too long, requested {prompt_tokens} prompt tokens and {max_tokens} generation tokens."
+                    )
+
+        if stats is not None:
+            stats.attempts = i + 1
+            stats.model = model
+            stats.prompt_tokens = prompt_tokens
 
+        # Providers count the requested completion tokens against the token quota
+        request_tokens = prompt_tokens + max_tokens
+        await wait_for_capacity(model, request_tokens)
+
+        try:
+            # Route to the replica with the least outstanding work
+            backend = get_backend_pool(model).choose()
+            async with backend.track(request_tokens):
+                started = time.monotonic()
+                first_token_latency = None
+
+                def record_first_token():
+                    nonlocal first_token_latency
+                    first_token_latency = time.monotonic() - started
+                    if on_first_token is not None:
+                        on_first_token()
+
+                def record_finish(reason: str):
+                    if stats is not None:
+                        stats.finish_reason = reason
+                    if stream_parser is not None:
+                        stream_parser.finish_reason = reason
+
+                if chat:
                     response = oai_chat_response(
                         prompt,
                         temperature,
@@ -98,17 +268,12 @@ async def generate_response(
                         history,
                         stops,
                         model=model,
+                        raw=settings.LLM_RAW_STREAM,
+                        base_url=backend.url,
+                        inactivity_timeout=inactivity_timeout,
+                        on_finish=record_finish,
                     )
-                case "gpt-3.5-turbo-instruct":
-                    prompt_tokens = oai_tokenize_prompt(prompt)
-                    if (
-                        prompt_tokens + max_tokens
-                        >= settings.LLM_TYPES[model]["max_tokens"]
-                    ):
-                        raise InvalidRequestError(
-                            f"Input prompt is too long, requested {prompt_tokens} prompt tokens and {max_tokens} generation tokens."
-                        )
-
+                else:
                     response = oai_prompt_response(
                         prompt,
                         temperature,
@@ -116,63 +281,165 @@ async def generate_response(
                         max_tokens,
                         stops,
                         model=model,
+                        raw=settings.LLM_RAW_STREAM,
+                        base_url=backend.url,
+                        inactivity_timeout=inactivity_timeout,
+                        on_finish=record_finish,
                     )
-                case _:
-                    if model not in settings.LLM_TYPES:
-                        raise NotImplementedError(
-                            "This LLM type is not supported currently."
-                        )
-
-                    prompt_tokens = oai_tokenize_prompt(prompt)
 
-                    allowed_tokens = settings.LLM_TYPES[model]["max_tokens"]
-                    if prompt_tokens + max_tokens > allowed_tokens:
-                        max_tokens = allowed_tokens - prompt_tokens
+                # Retries start the stream over
+                if stream_parser is not None:
+                    stream_parser.reset()
+                text = await read_stream(response, stream_parser, raw=settings.LLM_RAW_STREAM, on_first_token=record_first_token)
 
-                    if max_tokens < 256:
-                        raise InvalidRequestError(
-                            f"Input prompt is too long, requested {prompt_tokens} prompt tokens and {max_tokens} generation tokens."
-                        )
+            backend.record_success(prompt_settings.prompt_type, first_token_latency)
+            if stats is not None:
+                stats.first_token_latency = first_token_latency
+                stats.generation_time = time.monotonic() - started
+                if settings.PROMPT_TELEMETRY:
+                    stats.completion_tokens = count_tokens(text, model, memoize=False)
+            return text
+        except (GenerationError, RateLimitError, InvalidRequestError) as e:
+            # Invalid requests are our fault, not the backend's
+            if backend is not None and not isinstance(e, InvalidRequestError):
+                backend.record_failure(e)
 
-                    response = oai_prompt_response(
-                        prompt,
-                        temperature,
-                        timeout,
-                        max_tokens,
-                        stops,
-                        model=model,
-                    )
-            break
-        except (GenerationError, RateLimitError, InvalidRequestError):
             # Re-raise error if we're on the last try
-            model = orig_model
             if i == max_tries - 1:
                 raise
 
-            await asyncio.sleep(30 * (i + 1))
+            await asyncio.sleep(backoff_delay(i, e))
 
-    full_text = ""
-    async for chunk in response:
-        text = chunk.text
-        full_text += text
 
-    # Skip caching
-    if not cache:
-        return full_text
+def backoff_delay(attempt: int, error: Exception) -> float:
+    # Honor Retry-After, with jitter so workers don't all retry at the same moment
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, settings.LLM_BACKOFF_JITTER)
 
-    async with get_session() as db:
-        try:
-            prompt_model = Prompt(
-                hash=hex,
-                prompt=prompt,
-                response=full_text,
-                type=prompt_type,
-                model=settings.LLM_TYPE,
-                version=revision,
-            )
-            db.add(prompt_model)
-            await db.commit()
-        except IntegrityError:
-            await db.rollback()
-
-    return full_text
\ No newline at end of file
+    # Otherwise back off exponentially, with half of the delay randomized
+    delay = min(settings.LLM_BACKOFF_BASE * 2 ** attempt, settings.LLM_BACKOFF_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class LatencyTracker:
+    def __init__(self, max_samples: int = 200):
+        self.samples = defaultdict(lambda: deque(maxlen=max_samples))
+
+    def record(self, key: str, value: float):
+        self.samples[key].append(value)
+
+    def percentile(self, key: str, percentile: float, min_samples: int = 20) -> Optional[float]:
+        samples = self.samples[key]
+        if len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(int(len(ordered) * percentile / 100), len(ordered) - 1)
+        return ordered[index]
+
+
+first_token_latencies = LatencyTracker()
+
+
+async def run_hedged_generation(
+    prompt: str,
+    prompt_settings: GenerationSettings,
+    stops: Optional[List[str]],
+    history: Optional[List] = None,
+    max_tries: int = 2,
+    stats: Optional[GenerationStats] = None,
+    stream_parser: Optional[StreamParser] = None,
+) -> str:
+    """
+    Send a duplicate request if the first one is slower than usual to start streaming, and use whichever finishes first.
+    """
+    prompt_type = prompt_settings.prompt_type
+    delay = first_token_latencies.percentile(prompt_type, settings.LLM_HEDGE_PERCENTILE)
+    if delay is None:
+        delay = settings.LLM_HEDGE_DEFAULT_DELAY
+
+    request_stats = {}
+    request_parsers = {}
+    request_starts = {}
+
+    def start_request():
+        started = time.monotonic()
+        first_token = asyncio.Event()
+        task_stats = GenerationStats()
+
+        def on_first_token():
+            first_token_latencies.record(prompt_type, time.monotonic() - started)
+            first_token.set()
+
+        # Each request streams into its own copy of the parser
+        task_parser = deepcopy(stream_parser)
+
+        task = asyncio.create_task(
+            run_generation(prompt, prompt_settings, stops, history, max_tries, task_parser, on_first_token=on_first_token, stats=task_stats)
+        )
+        request_stats[task] = task_stats
+        request_parsers[task] = task_parser
+        request_starts[task] = (started, first_token)
+        return task, first_token
+
+    def winner(task):
+        if stats is not None:
+            for key, value in request_stats[task]:
+                setattr(stats, key, value)
+        if stream_parser is not None:
+            stream_parser.__dict__.update(request_parsers[task].__dict__)
+        return task.result()
+
+    primary, primary_first_token = start_request()
+    first_token_wait = asyncio.create_task(primary_first_token.wait())
+    try:
+        await asyncio.wait({primary, first_token_wait}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        first_token_wait.cancel()
+
+    if primary.done() or primary_first_token.is_set():
+        await primary
+        return winner(primary)
+
+    secondary, _ = start_request()
+    pending = {primary, secondary}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return winner(task)
+                error = task.exception()
+    finally:
+        # Cancel the loser, so it stops streaming tokens we won't use
+        for task in pending:
+            task.cancel()
+            # A loser that never started streaming took at least this long, so record that as a lower bound.
+            # Otherwise only fast requests are sampled once hedging kicks in, and the hedge delay drifts down.
+            started, first_token = request_starts[task]
+            if not first_token.is_set():
+                first_token_latencies.record(prompt_type, time.monotonic() - started)
+    raise error
+
+
+async def read_stream(
+    response: AsyncGenerator[str | bytes, None],
+    stream_parser: Optional[StreamParser] = None,
+    raw: bool = False,
+    on_first_token: Optional[Callable[[], None]] = None,
+) -> str:
+    # Collect the chunks and join once at the end, so long responses aren't copied on every token
+    chunks = []
+    async for chunk in response:
+        if on_first_token is not None and len(chunks) == 0:
+            on_first_token()
+        chunks.append(chunk)
+        if stream_parser is not None and stream_parser.feed(chunk.decode("utf-8") if raw else chunk):
+            # The parser has what it needs, so stop paying for tokens
+            await response.aclose()
+            break
+
+    if raw:
+        return b"".join(chunks).decode("utf-8")
+    return "".join(chunks)
\ No newline at end of file
@@ -1,6 +1,10 @@
-from sqlmodel import Field, UniqueConstraint
+from typing import Optional
+
+from sqlalchemy import LargeBinary
+from sqlmodel import Column, Field
 
 from app.db.base_model import BaseDBModel
+from app.db.compression import CompressedText
 from app.util import BaseEnum
 
 
@@ -12,13 +16,30 @@ class PromptTypes(str, BaseEnum):
     title = "title"
     toc = "toc"
     rewrite = "rewrite"
+    plan = "plan"
 
 
 class Prompt(BaseDBModel, table=True):
-    __table_args__ = (UniqueConstraint("hash", "model", "version", name="unique_hash_model_version"),)
-    hash: str = Field(index=True)
-    prompt: str
-    response: str
+    key: bytes = Field(sa_column=Column(LargeBinary, nullable=False, unique=True, index=True))  # See prompt_cache_key
+    prompt: str = Field(sa_column=Column(CompressedText, nullable=False))
+    response: str = Field(sa_column=Column(CompressedText, nullable=False))
+    finish_reason: Optional[str]  # Why generation stopped, "length" if max_tokens cut it off
     type: PromptTypes
     model: str
     version: int = Field(default=1)
+
+
+class PromptTelemetry(BaseDBModel, table=True):
+    hash: str = Field(index=True)  # Hex of the prompt cache key
+    type: PromptTypes = Field(index=True)
+    model: str  # Model requested for the prompt
+    model_used: Optional[str]  # Model that generated it, after any fallback to the extended model
+    version: int = Field(default=1)
+    cache_hit: bool = Field(default=False)
+    retries: int = Field(default=0)
+    first_token_latency: Optional[float]
+    latency: float
+    prompt_tokens: Optional[int]
+    completion_tokens: Optional[int]
+    tokens_per_second: Optional[float]
+    error: Optional[str]  # Exception type if the call failed
@@ -1,8 +1,10 @@
 import json
+import os
 from collections import OrderedDict
-from typing import List, Optional
+from copy import deepcopy
+from typing import Callable, Dict, Hashable, List, Optional
 
-from jinja2 import Environment, FileSystemLoader, Template
+from jinja2 import Environment, FileSystemLoader
 
 from app.course.schemas import ResearchNote
 from app.settings import settings
@@ -45,22 +47,75 @@ def render_input(input: OrderedDict) -> str:
     return input_prompt
 
 
+# Templates are compiled once per worker.  With PROMPT_AUTO_RELOAD, jinja recompiles them when they change on disk.
+template_env = Environment(
+    loader=FileSystemLoader(settings.PROMPT_TEMPLATE_DIR),
+    auto_reload=settings.PROMPT_AUTO_RELOAD,
+    cache_size=-1,
+)
+
+# Parsed examples and rendered example blocks, with the mtime of the examples file they came from
+example_cache: Dict[str, tuple[float, list]] = {}
+rendered_example_cache: Dict[tuple[str, Hashable], tuple[float, str]] = {}
+
+
+def examples_mtime(name: str) -> float:
+    if not settings.PROMPT_AUTO_RELOAD:
+        return 0
+    return os.path.getmtime(os.path.join(settings.EXAMPLE_JSON_DIR, f"{name}.json"))
+
+
+def load_examples(name: str) -> list:
+    """
+    Load examples from EXAMPLE_JSON_DIR.  The list is shared, so copy it before changing it.
+    """
+    mtime = examples_mtime(name)
+    cached = example_cache.get(name)
+    if cached is None or cached[0] != mtime:
+        with open(os.path.join(settings.EXAMPLE_JSON_DIR, f"{name}.json")) as f:
+            cached = (mtime, json.load(f))
+        example_cache[name] = cached
+    return cached[1]
+
+
+def rendered_examples(name: str, variant: Hashable = None, transform: Optional[Callable[[list], list]] = None) -> str:
+    """
+    Render the example block for a prompt once.  transform adjusts a copy of the examples before rendering, and
+    variant identifies it, like the component set for lessons.
+    """
+    mtime = examples_mtime(name)
+    cached = rendered_example_cache.get((name, variant))
+    if cached is None or cached[0] != mtime:
+        examples = load_examples(name)
+        if transform is not None:
+            examples = transform(deepcopy(examples))
+        cached = (mtime, render_examples(examples))
+        rendered_example_cache[(name, variant)] = cached
+    return cached[1]
+
+
+def preload_prompts():
+    for filename in os.listdir(settings.PROMPT_TEMPLATE_DIR):
+        if filename.endswith(".jinja"):
+            template_env.get_template(filename)
+    for filename in os.listdir(settings.EXAMPLE_JSON_DIR):
+        if filename.endswith(".json"):
+            rendered_examples(filename[:-len(".json")])
+
+
 def build_prompt(
     template_name: str,
     input: OrderedDict,
-    examples: Optional[list] = None,
+    examples: Optional[list | str] = None,
     include_examples: bool = True,
     **keys,
 ) -> str:
-    with open(f"{settings.PROMPT_TEMPLATE_DIR}/{template_name}.jinja") as file_:
-        template_str = file_.read()
-    template = Environment(
-        loader=FileSystemLoader(settings.PROMPT_TEMPLATE_DIR)
-    ).from_string(template_str)
+    template = template_env.get_template(f"{template_name}.jinja")
     instruction = template.render(**keys)
     input_prompt = render_input(input)
     if include_examples:
-        example_prompt = render_examples(examples)
+        # Examples can be passed already rendered, see rendered_examples
+        example_prompt = examples if isinstance(examples, str) else render_examples(examples)
         prompt = f"{instruction}\n\n{example_prompt}\n{input_prompt}"
     else:
         prompt = f"{instruction}\n\n{input_prompt}"
@@ -74,3 +129,6 @@ def render_research_notes(research_notes: List[ResearchNote] | None) -> str:
         content = f"```{content}```"
         research_content += f"* {content}\n"
     return research_content
+
+
+preload_prompts()
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from typing import Dict, List
+
+import ray
+
+from app.settings import settings
+
+RATE_LIMITER_NAME = "llm_rate_limiter"
+
+# Buckets start with this many seconds of budget, and fill up from there.  Starting full would send a minute of
+# requests at once every time the workers restart.
+INITIAL_BUCKET_SECONDS = 1
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = min(self.rate * INITIAL_BUCKET_SECONDS, per_minute)
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: int) -> float:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+        # The bucket can go into debt, so callers queue up in the order they reserved
+        # Requests larger than the whole budget are capped so they can still be admitted
+        self.level -= min(amount, self.capacity)
+        if self.level >= 0:
+            return 0
+        return -self.level / self.rate
+
+
+class RateLimiter:
+    def __init__(self, llm_types: Dict[str, dict]):
+        self.buckets: Dict[str, List[tuple[str, TokenBucket]]] = {}
+        for model, model_info in llm_types.items():
+            buckets = []
+            if model_info.get("rpm"):
+                buckets.append(("requests", TokenBucket(model_info["rpm"])))
+            if model_info.get("tpm"):
+                buckets.append(("tokens", TokenBucket(model_info["tpm"])))
+            if buckets:
+                self.buckets[model] = buckets
+
+    def reserve(self, model: str, tokens: int) -> float:
+        # Returns how long the caller should wait before sending the request
+        delay = 0
+        for kind, bucket in self.buckets.get(model, []):
+            amount = 1 if kind == "requests" else tokens
+            delay = max(delay, bucket.reserve(amount))
+        return delay
+
+
+RemoteRateLimiter = ray.remote(num_cpus=0)(RateLimiter)
+
+_limiter = None
+
+
+def create_rate_limiter():
+    # Called from the driver, so the actor lives as long as the driver holds the handle
+    return RemoteRateLimiter.options(name=RATE_LIMITER_NAME, get_if_exists=True).remote(settings.LLM_TYPES)
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        if ray.is_initialized():
+            try:
+                _limiter = ray.get_actor(RATE_LIMITER_NAME)
+            except ValueError:
+                _limiter = RateLimiter(settings.LLM_TYPES)
+        else:
+            _limiter = RateLimiter(settings.LLM_TYPES)
+    return _limiter
+
+
+def is_rate_limited(model: str) -> bool:
+    model_info = settings.LLM_TYPES.get(model, {})
+    return bool(model_info.get("rpm") or model_info.get("tpm"))
+
+
+async def wait_for_capacity(model: str, tokens: int):
+    if not is_rate_limited(model):
+        return
+
+    limiter = get_rate_limiter()
+    if isinstance(limiter, RateLimiter):
+        delay = limiter.reserve(model, tokens)
+    else:
+        delay = await limiter.reserve.remote(model, tokens)
+
+    if delay > 0:
+        await asyncio.sleep(delay)
@@ -3,16 +3,26 @@ from typing import List, Optional
 from pydantic import BaseModel
 
 
-class LLMResponse(BaseModel):
-    text: str
-    tokens: int
-
-
 class GenerationSettings(BaseModel):
     temperature: float
     max_tokens: int
+    min_response_tokens: Optional[int]  # With LLM_FIT_PROMPTS, shrink max_tokens down to this before switching to the extended model
     timeout: int
+    inactivity_timeout: Optional[int]  # Abort and retry if no tokens arrive for this long, see LLM_INACTIVITY_TIMEOUT
     stop_sequences: Optional[List[str]]
     prompt_type: str
     component_name: Optional[str]
     model: Optional[str]
+    hedge: bool = False  # Send a backup request if the first is slow to start, see LLM_HEDGE_REQUESTS
+
+
+class GenerationStats(BaseModel):
+    model: Optional[str] = None  # Model actually used, after any fallback
+    attempts: int = 0
+    first_token_latency: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    generation_time: Optional[float] = None
+    finish_reason: Optional[str] = None
+    cache_hit: bool = False  # Set from the cache lookups, not from attempts, since waiting on another caller isn't a hit
+    error: Optional[str] = None  # Exception type if the call failed
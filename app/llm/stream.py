@@ -0,0 +1,39 @@
+from app.util import JSONExtractor
+
+
+class StreamParser:
+    """
+    Consumes generated text as it streams in.  feed returns True once the parser has everything it needs, which ends the stream early.
+    """
+    def __init__(self):
+        self.received = 0
+        self.finish_reason = None  # Set from the stream, "length" means max_tokens cut the response off
+
+    def feed(self, text: str) -> bool:
+        self.received += len(text)
+        return False
+
+    def reset(self):
+        self.received = 0
+        self.finish_reason = None
+
+
+class JSONStreamParser(StreamParser):
+    """
+    Ends the stream as soon as the first top-level JSON object or list closes, so text after it is never generated.
+    prefix is the start of the response when it's part of the prompt, like the outline hint for finetuned models.
+    """
+    def __init__(self, open_char: str = "{", prefix: str = ""):
+        super().__init__()
+        self.extractor = JSONExtractor(open_char)
+        self.prefix = prefix
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.extractor.reset()
+        self.extractor.feed(self.prefix)
+
+    def feed(self, text: str) -> bool:
+        super().feed(text)
+        return self.extractor.feed(text)
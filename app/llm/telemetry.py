@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import Integer, func
+from sqlmodel import select
+
+from app.db.session import get_session
+from app.llm.models import PromptTelemetry
+from app.llm.schemas import GenerationStats
+from app.settings import settings
+
+# Rows are buffered per worker and written in batches, so telemetry doesn't add a write to every call
+telemetry_buffer: List[PromptTelemetry] = []
+flush_tasks = set()
+
+
+def record_telemetry(
+    hash: str,
+    prompt_type: str,
+    model: str,
+    version: int,
+    latency: float,
+    stats: GenerationStats,
+):
+    if not settings.PROMPT_TELEMETRY:
+        return
+
+    tokens_per_second = None
+    if stats.completion_tokens and stats.generation_time:
+        streaming_time = stats.generation_time - (stats.first_token_latency or 0)
+        if streaming_time > 0:
+            tokens_per_second = stats.completion_tokens / streaming_time
+
+    telemetry_buffer.append(
+        PromptTelemetry(
+            hash=hash,
+            type=prompt_type,
+            model=model,
+            model_used=stats.model,
+            version=version,
+            cache_hit=stats.cache_hit,
+            retries=max(stats.attempts - 1, 0),
+            first_token_latency=stats.first_token_latency,
+            latency=latency,
+            prompt_tokens=stats.prompt_tokens,
+            completion_tokens=stats.completion_tokens,
+            tokens_per_second=tokens_per_second,
+            error=stats.error,
+        )
+    )
+
+    if len(telemetry_buffer) >= settings.PROMPT_TELEMETRY_BATCH_SIZE:
+        task = asyncio.get_running_loop().create_task(flush_telemetry())
+        flush_tasks.add(task)
+        task.add_done_callback(flush_tasks.discard)
+
+
+async def flush_telemetry():
+    if not telemetry_buffer:
+        return
+
+    rows = telemetry_buffer[:]
+    telemetry_buffer.clear()
+    try:
+        async with get_session() as db:
+            db.add_all(rows)
+            await db.commit()
+    except Exception as e:
+        # Losing telemetry shouldn't fail a book
+        print(f"Failed to write {len(rows)} telemetry rows: {e}")
+
+
+async def summarize_telemetry(since: Optional[datetime] = None) -> List[Dict]:
+    query = select(
+        PromptTelemetry.type,
+        PromptTelemetry.model_used,
+        func.count(PromptTelemetry.id),
+        func.avg(PromptTelemetry.cache_hit.cast(Integer)),
+        func.avg(PromptTelemetry.retries),
+        func.avg(PromptTelemetry.first_token_latency),
+        func.avg(PromptTelemetry.latency),
+        func.avg(PromptTelemetry.prompt_tokens),
+        func.avg(PromptTelemetry.completion_tokens),
+        func.avg(PromptTelemetry.tokens_per_second),
+        func.avg((PromptTelemetry.error != None).cast(Integer)),
+    ).group_by(PromptTelemetry.type, PromptTelemetry.model_used)
+    if since is not None:
+        query = query.where(PromptTelemetry.created >= since)
+
+    async with get_session() as db:
+        result = await db.exec(query)
+        rows = result.all()
+
+    keys = [
+        "type",
+        "model",
+        "calls",
+        "cache_hit_rate",
+        "avg_retries",
+        "avg_first_token_latency",
+        "avg_latency",
+        "avg_prompt_tokens",
+        "avg_completion_tokens",
+        "avg_tokens_per_second",
+        "failure_rate",
+    ]
+    return [dict(zip(keys, row)) for row in rows]
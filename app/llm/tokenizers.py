@@ -0,0 +1,95 @@
+import re
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+
+import tiktoken
+
+from app.settings import settings
+
+# Tiktoken never merges a run of newlines with the text after it, so counting the pieces that end in newlines separately
+# gives the same total.  Templates and examples repeat across prompts, so their pieces are only tokenized once.
+# Sentencepiece tokenizers add a prefix space to each piece and can merge across newlines, so they count whole texts.
+SEGMENT_PATTERN = re.compile(r"[^\n]*\n+|[^\n]+$")
+
+DEFAULT_ENCODING = "cl100k_base"
+
+
+def tiktoken_counter(name: str) -> Callable[[str], int]:
+    try:
+        encoding = tiktoken.encoding_for_model(name)
+    except KeyError:
+        encoding = tiktoken.get_encoding(name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def huggingface_counter(name: str) -> Callable[[str], int]:
+    from transformers import AutoTokenizer
+
+    # Only use tokenizers that are already downloaded, so workers never block on the hub
+    tokenizer = AutoTokenizer.from_pretrained(name, local_files_only=True)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def load_counter(model: str) -> Tuple[Callable[[str], int], bool]:
+    """
+    Returns the counter, and whether counts can be summed over segments.
+    """
+    name = settings.LLM_TYPES.get(model, {}).get("tokenizer")
+    if name is None:
+        try:
+            return tiktoken_counter(model), True
+        except KeyError:
+            return tiktoken_counter(DEFAULT_ENCODING), True
+
+    if name.startswith("tiktoken:"):
+        return tiktoken_counter(name.split(":", 1)[1]), True
+
+    try:
+        return huggingface_counter(name), False
+    except Exception as e:
+        print(f"Could not load tokenizer {name} for {model}, falling back to {DEFAULT_ENCODING}: {e}")
+        return tiktoken_counter(DEFAULT_ENCODING), True
+
+
+class SegmentCounter:
+    def __init__(self, count: Callable[[str], int], max_size: int, memoize_segments: bool = True):
+        self.count = count
+        self.max_size = max_size
+        self.memoize_segments = memoize_segments
+        self.counts = OrderedDict()
+
+    def __call__(self, text: str, memoize: bool = True) -> int:
+        if not memoize or not self.memoize_segments:
+            return self.count(text)
+
+        total = 0
+        for segment in SEGMENT_PATTERN.findall(text):
+            tokens = self.counts.get(segment)
+            if tokens is None:
+                tokens = self.count(segment)
+                self.counts[segment] = tokens
+                if len(self.counts) > self.max_size:
+                    self.counts.popitem(last=False)
+            else:
+                self.counts.move_to_end(segment)
+            total += tokens
+        return total
+
+
+counters: Dict[str, SegmentCounter] = {}
+
+
+def get_token_counter(model: str) -> SegmentCounter:
+    counter = counters.get(model)
+    if counter is None:
+        count, memoize_segments = load_counter(model)
+        counter = SegmentCounter(count, settings.TOKENIZER_CACHE_SIZE, memoize_segments)
+        counters[model] = counter
+    return counter
+
+
+def count_tokens(text: str, model: str | None = None, memoize: bool = True) -> int:
+    """
+    Count tokens with the model's tokenizer.  Pass memoize=False for text that won't repeat, like responses.
+    """
+    return get_token_counter(model or settings.LLM_TYPE)(text, memoize)
@@ -0,0 +1,218 @@
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+import ray
+
+from app.settings import settings
+
+METRICS_AGGREGATOR_NAME = "metrics_aggregator"
+
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRIC_HELP = {
+    "courses_started_total": ("counter", "Course stages started"),
+    "courses_finished_total": ("counter", "Course stages finished"),
+    "courses_failed_total": ("counter", "Course stages that failed"),
+    "llm_calls_total": ("counter", "LLM calls by prompt type, model, and whether they hit the cache"),
+    "llm_call_seconds": ("histogram", "Time to get an LLM response, including cache lookups and retries"),
+    "llm_requests_in_flight": ("gauge", "LLM requests currently streaming"),
+    "cache_lookups_total": ("counter", "Cache lookups by table and result"),
+    "retrieval_seconds": ("histogram", "Time to run retrieval searches"),
+    "pdf_parse_seconds": ("histogram", "Time to parse a pdf"),
+    "embedding_seconds": ("histogram", "Time to embed passages"),
+    "lesson_priming_characters_lost_total": ("counter", "Characters of the previous section that chapters generated in parallel were not primed with"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self.gauges: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+
+    def inc(self, name: str, value: float, labels: Labels):
+        self.counters[(name, labels)] += value
+
+    def add_gauge(self, name: str, value: float, labels: Labels):
+        self.gauges[(name, labels)] += value
+
+    def observe(self, name: str, value: float, labels: Labels):
+        # Bucket counts, then the sum and count of all observations
+        histogram = self.histograms.setdefault((name, labels), [0] * (len(HISTOGRAM_BUCKETS) + 2))
+        for i, bucket in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bucket:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def merge(self, counters, histograms):
+        for key, value in counters.items():
+            self.counters[key] += value
+        for key, values in histograms.items():
+            histogram = self.histograms.setdefault(key, [0] * (len(HISTOGRAM_BUCKETS) + 2))
+            for i, value in enumerate(values):
+                histogram[i] += value
+
+    def take_deltas(self):
+        counters, histograms = dict(self.counters), self.histograms
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        return counters, histograms, dict(self.gauges)
+
+
+registry = MetricsRegistry()
+
+
+def label_key(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc_counter(name: str, value: float = 1, **labels):
+    registry.inc(name, value, label_key(labels))
+
+
+def add_gauge(name: str, value: float, **labels):
+    registry.add_gauge(name, value, label_key(labels))
+
+
+def observe(name: str, value: float, **labels):
+    registry.observe(name, value, label_key(labels))
+
+
+@contextmanager
+def timer(name: str, **labels):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def render_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsAggregator:
+    """
+    Sums the metrics pushed by every worker, and renders them in the prometheus text format.
+    """
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        self.worker_gauges: Dict[str, Dict[Tuple[str, Labels], float]] = {}
+
+    def push(self, worker_id: str, counters, histograms, gauges):
+        self.registry.merge(counters, histograms)
+        self.worker_gauges[worker_id] = gauges
+
+    def render(self) -> str:
+        gauges = defaultdict(float)
+        for worker_gauges in self.worker_gauges.values():
+            for key, value in worker_gauges.items():
+                gauges[key] += value
+
+        series = defaultdict(list)
+        for (name, labels), value in self.registry.counters.items():
+            series[name].append(f"{name}{render_labels(labels)} {value}")
+        for (name, labels), value in gauges.items():
+            series[name].append(f"{name}{render_labels(labels)} {value}")
+        for (name, labels), values in self.registry.histograms.items():
+            for bucket, count in zip(HISTOGRAM_BUCKETS, values):
+                bucket_label = f'le="{bucket}"'
+                series[name].append(f"{name}_bucket{render_labels(labels, bucket_label)} {count}")
+            inf_label = 'le="+Inf"'
+            series[name].append(f"{name}_bucket{render_labels(labels, inf_label)} {values[-1]}")
+            series[name].append(f"{name}_sum{render_labels(labels)} {values[-2]}")
+            series[name].append(f"{name}_count{render_labels(labels)} {values[-1]}")
+
+        lines = []
+        for name in sorted(series.keys()):
+            kind, description = METRIC_HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines += series[name]
+        return "\n".join(lines) + "\n"
+
+
+RemoteMetricsAggregator = ray.remote(num_cpus=0)(MetricsAggregator)
+
+_aggregator = None
+
+
+def create_metrics_aggregator():
+    # Called from the driver, like the rate limiter
+    return RemoteMetricsAggregator.options(name=METRICS_AGGREGATOR_NAME, get_if_exists=True).remote()
+
+
+def get_metrics_aggregator():
+    global _aggregator
+    if _aggregator is None and ray.is_initialized():
+        try:
+            _aggregator = ray.get_actor(METRICS_AGGREGATOR_NAME)
+        except ValueError:
+            pass
+    return _aggregator
+
+
+async def push_metrics():
+    aggregator = get_metrics_aggregator()
+    if aggregator is None:
+        return
+
+    counters, histograms, gauges = registry.take_deltas()
+    try:
+        await aggregator.push.remote(str(os.getpid()), counters, histograms, gauges)
+    except Exception as e:
+        # Put the deltas back, so they go out with the next push
+        registry.merge(counters, histograms)
+        if settings.DEBUG:
+            print(f"Failed to push metrics: {e}")
+
+
+@asynccontextmanager
+async def pushing_metrics():
+    """
+    Push this worker's metrics to the driver periodically while the block runs, and once more at the end.
+    """
+    async def push_periodically():
+        while True:
+            await asyncio.sleep(settings.METRICS_PUSH_INTERVAL)
+            await push_metrics()
+
+    task = asyncio.create_task(push_periodically())
+    try:
+        yield
+    finally:
+        task.cancel()
+        await push_metrics()
+
+
+def serve_metrics(aggregator, port: int) -> ThreadingHTTPServer:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = ray.get(aggregator.render.remote()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((settings.METRICS_HOST, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
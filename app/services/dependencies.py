@@ -1,31 +1,36 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 
+from sqlalchemy import tuple_
 from sqlmodel import select
-from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app.db.loader import BatchLoader
 from app.db.session import get_session
 from app.services.models import ScrapedData, ServiceResponse
 
 
-async def get_stored_urls(urls: List[str]) -> List[Optional[str]]:
+async def load_stored_urls(urls: List[str]) -> Dict[str, str]:
     async with get_session() as db:
         query = await db.exec(select(ScrapedData).where(ScrapedData.source.in_(urls)))
         stored_urls = query.all()
-    return_data = {}
-    for url in urls:
-        return_data[url] = None
-        for stored_url in stored_urls:
-            if url == stored_url.source:
-                return_data[url] = stored_url.uploaded
-    return [return_data[url] for url in urls]
+    return {stored_url.source: stored_url.uploaded for stored_url in stored_urls}
 
 
-async def get_service_response_model(name: str, hex: str):
+async def load_service_responses(keys: List[tuple[str, str]]) -> Dict[tuple[str, str], ServiceResponse]:
     async with get_session() as db:
         query = await db.exec(
-            select(ServiceResponse).where(
-                ServiceResponse.hash == hex, ServiceResponse.name == name
-            )
+            select(ServiceResponse).where(tuple_(ServiceResponse.name, ServiceResponse.hash).in_(keys))
         )
-        service_model = query.first()
-    return service_model
+        service_models = query.all()
+    return {(str(s.name), s.hash): s for s in service_models}
+
+
+stored_url_loader = BatchLoader(load_stored_urls)
+service_response_loader = BatchLoader(load_service_responses)
+
+
+async def get_stored_urls(urls: List[str]) -> List[Optional[str]]:
+    return await stored_url_loader.load_many(urls)
+
+
+async def get_service_response_model(name: str, hex: str):
+    return await service_response_loader.load((str(name), hex))
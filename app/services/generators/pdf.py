@@ -10,6 +10,7 @@ from fitz import FileDataError
 from pydantic import BaseModel
 
 from app.db.session import get_session
+from app.metrics import inc_counter, timer
 from app.services.adaptors.serpapi import serpapi_pdf_search_settings
 from app.services.adaptors.serply import serply_pdf_search_settings
 from app.services.dependencies import get_stored_urls
@@ -113,6 +114,8 @@ async def download_and_parse_pdfs(
 
     links = [search_result.link for search_result in deduped_search_results]
     pdf_paths = await get_stored_urls(links)
+    for pdf_path in pdf_paths:
+        inc_counter("cache_lookups_total", table="scrapeddata", result="hit" if pdf_path else "miss")
 
     coroutines = [
         download_and_parse_pdf(search_result, pdf_path) for search_result, pdf_path in zip(deduped_search_results, pdf_paths)
@@ -148,7 +151,8 @@ async def download_and_parse_pdf(search_result: PDFSearchResult, pdf_path: Optio
             return
 
     try:
-        pdf_content = parse_pdf(pdf_data)
+        with timer("pdf_parse_seconds"):
+            pdf_content = parse_pdf(pdf_data)
     except FileDataError:
         return
 
@@ -3,6 +3,7 @@ from sqlmodel import JSON, Column, Field, UniqueConstraint, Session
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.db.base_model import BaseDBModel
+from app.db.compression import CompressedJSON
 from app.db.session import get_session
 from app.services.schemas import ServiceInfo, ServiceNames
 
@@ -11,7 +12,7 @@ class ServiceResponse(BaseDBModel, table=True):
     __table_args__ = (UniqueConstraint("hash", "name", name="unique_hash_name"),)
     hash: str = Field(index=True)
     request: ServiceInfo = Field(sa_column=Column(JSON), default=dict(), nullable=False)
-    response: dict = Field(sa_column=Column(JSON), default=dict(), nullable=False)
+    response: dict = Field(sa_column=Column(CompressedJSON), default=dict(), nullable=False)
     name: ServiceNames
 
     @validator("request")
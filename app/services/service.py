@@ -1,6 +1,7 @@
 import hashlib
 
 from app.db.session import get_session
+from app.metrics import inc_counter
 from app.services.adaptors.custom_search import custom_search_router
 from app.services.adaptors.serpapi import serpapi_router
 from app.services.adaptors.serply import serply_router
@@ -23,6 +24,7 @@ async def get_service_response(
     if cache:
         # Break if we've already run this query
         service_model = await get_service_response_model(service_settings.name, hex)
+        inc_counter("cache_lookups_total", table="serviceresponse", result="hit" if service_model is not None else "miss")
 
         if service_model is not None:
             return service_model.response
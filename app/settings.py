@@ -1,5 +1,5 @@
 import os
-from typing import Literal, Optional, List
+from typing import Dict, Literal, Optional, List
 
 from dotenv import find_dotenv
 from pydantic import BaseSettings
@@ -12,35 +12,74 @@ class Settings(BaseSettings):
     DATA_DIR = os.path.join(BASE_DIR, "data")  # Where to save data
     PROMPT_TEMPLATE_DIR: str = os.path.join(BASE_DIR, "llm", "templates")
     EXAMPLE_JSON_DIR: str = os.path.join(BASE_DIR, "llm", "examples")
+    PROMPT_AUTO_RELOAD: bool = False  # Pick up template and example edits without restarting, for development
 
     # Database
     DATABASE_URL: str = "postgresql://localhost/textbook"
+    PROMPT_CACHE_SIZE: int = 32 * 1024 * 1024  # Characters of llm responses to keep in memory.  Each worker has its own, so a node can use this times its workers.
+    PROMPT_CACHE_PATH: Optional[str] = None  # Local sqlite file to cache llm responses on disk, off if not set
+    PROMPT_LOCK_ACROSS_WORKERS: bool = False  # Use postgres advisory locks so only one worker generates each prompt.  Holds a connection per prompt being generated.
+    PROMPT_LOCK_POLL_INTERVAL: float = 5  # Seconds between attempts to take a prompt lock held by another worker
+    PROMPT_TELEMETRY: bool = False  # Record latency, tokens, retries, and failures for each llm call.  Needs the prompttelemetry migration.
+    PROMPT_TELEMETRY_BATCH_SIZE: int = 100  # Telemetry rows to buffer before writing them
+    DB_COMPRESSION_LEVEL: int = 6  # zlib level for compressed columns, 1 is fastest and 9 is smallest
     DEBUG: bool = False
 
     # Content
     SECTIONS_PER_LESSON: int = 30  # Lower this to make books shorter
     SECTIONS_PER_GENERATION: int = 5 # How many sections to generate in one prompt
+    LESSON_PARALLEL_CHAPTERS: bool = False  # Generate top level chapters concurrently, each primed with only its own header
+    LESSON_MAX_CONTINUATIONS: int = 2  # Times to continue a chunk that hit max_tokens, instead of regenerating it.  Completion models only.
+    LESSON_PROMPT_LAYOUT: str = "default"  # Set to "prefix" to put the parts shared by every chunk first, for backends with prefix caching
     MAX_DOWNLOAD_SIZE: int = 6 * 1024 * 1024  # Max pdf size to download, 6 MB
     FINETUNED: bool = False # If we're using a finetuned textbook gen model
+    FUSED_COURSE_PLAN: bool = False  # Generate concepts and outline with one prompt instead of two
     INCLUDE_EXAMPLES: bool = (
         True  # Include examples in prompts, False with custom model
     )
+    EXAMPLE_SELECTION: bool = False  # Pick the examples most similar to each prompt, instead of including all of them.  Changes prompts, so cached responses miss.
+    EXAMPLE_COUNT: int = 2  # Max examples per prompt when selecting
+    EXAMPLE_TOKEN_BUDGET: int = 2048  # Max tokens of examples per prompt when selecting
 
     # LLM
+    # Add "rpm" and "tpm" keys to a model to budget requests and tokens per minute across all workers
+    # Add a "tokenizer" key with a local huggingface tokenizer name, or "tiktoken:<encoding>", to count tokens exactly
     LLM_TYPES = {
         "gpt-3.5-turbo": {"max_tokens": 4097},
         "gpt-3.5-turbo-16k": {"max_tokens": 16384},
         "gpt-3.5-turbo-instruct": {"max_tokens": 4097},
-        "llama": {"max_tokens": 8192},
+        "llama": {"max_tokens": 8192, "tokenizer": "vikp/code_llama_7b_hf"},
         "gpt-4": {"max_tokens": 8192},
         "gpt-4-32k": {"max_tokens": 32768},
     }
 
     LLM_TEMPERATURE: float = 0.5
     LLM_TIMEOUT: int = 480
+    LLM_INACTIVITY_TIMEOUT: int = 60  # Seconds without a streamed token before a generation is retried
     LLM_MAX_RESPONSE_TOKENS: int = 2048
+    TOKENIZER_CACHE_SIZE: int = 100000  # Prompt pieces to memoize token counts for, per model
+    LLM_FIT_PROMPTS: bool = False  # Trim research notes, outline, and examples, and shrink max_tokens, to fit the model before using LLM_EXTENDED_TYPE
     OPENAI_KEY: str = ""
     OPENAI_BASE_URL: Optional[str] = None
+    LLM_BACKENDS: Dict[str, List[str]] = {}  # Model name to a list of OpenAI-compatible base urls to balance across
+    LLM_BACKEND_MAX_FAILURES: int = 3  # Consecutive errors before a backend is taken out of rotation
+    LLM_BACKEND_EJECT_SECONDS: int = 30  # How long a failing backend stays out of rotation
+    LLM_ADAPTIVE_CONCURRENCY: bool = False  # Adjust in-flight requests per backend based on latency and rate limits.  Off means unbounded.
+    LLM_CONCURRENCY_INITIAL: int = 8  # Starting in-flight request limit per backend per worker
+    LLM_CONCURRENCY_MIN: int = 1
+    LLM_CONCURRENCY_MAX: int = 100
+    LLM_CONCURRENCY_BACKOFF: float = 0.5  # Multiply the limit by this on rate limits or high latency
+    LLM_CONCURRENCY_LATENCY_TOLERANCE: float = 3  # Time to first token over this multiple of the baseline counts as congestion
+    LLM_CONCURRENCY_COOLDOWN: float = 5  # Minimum seconds between decreases
+    LLM_BACKOFF_BASE: float = 20  # Seconds to wait before the first retry, doubles each retry
+    LLM_BACKOFF_MAX: float = 120
+    LLM_BACKOFF_JITTER: float = 5  # Max random seconds added to Retry-After
+    LLM_POOL_SIZE: int = 100  # Max open connections to the LLM API per worker
+    LLM_KEEPALIVE_TIMEOUT: int = 60  # Seconds to keep idle LLM API connections open
+    LLM_RAW_STREAM: bool = False  # Read streamed text as raw bytes, skipping json decoding when possible
+    LLM_HEDGE_REQUESTS: bool = False  # Hedge short structured prompts with a backup request when the first is slow
+    LLM_HEDGE_PERCENTILE: float = 95  # Time to first token percentile to wait before sending the backup request
+    LLM_HEDGE_DEFAULT_DELAY: float = 5  # Seconds to wait before hedging until enough latencies are recorded
     LLM_TYPE: str = "gpt-3.5-turbo"
     LLM_INSTRUCT_TYPE: str = "gpt-3.5-turbo-instruct"
     LLM_EXTENDED_TYPE: str = "gpt-3.5-turbo-16k"
@@ -65,6 +104,10 @@ class Settings(BaseSettings):
     RAY_DASHBOARD_HOST: str = "127.0.0.1"
     RAY_CORES_PER_WORKER = 1 # How many cpu cores to allocate per worker
 
+    # Metrics
+    METRICS_HOST: str = "127.0.0.1"  # Where the driver serves metrics, with --metrics-port
+    METRICS_PUSH_INTERVAL: float = 10  # Seconds between metric pushes from each worker
+
     class Config:
         env_file = find_dotenv("local.env")
 
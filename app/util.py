@@ -1,6 +1,6 @@
+import re
 import traceback
 from enum import Enum
-import regex
 
 import ftfy
 
@@ -12,22 +12,131 @@ class BaseEnum(Enum):
         return str(self.value)
 
 
+STRING_SPECIAL_CHARS = re.compile(r'["\\]')
+
+
+class JSONExtractor:
+    """
+    Finds the first top-level JSON object or list in text as it streams in, in one pass over the text.  Brackets inside
+    strings don't count.  feed returns True once the value closes, and finish looks further if it never does.
+    """
+    def __init__(self, open_char: str = "{"):
+        self.open_char = open_char
+        self.close_char = "}" if open_char == "{" else "]"
+        self.value_special_chars = re.compile(f'["{re.escape(open_char)}{re.escape(self.close_char)}]')
+        self.bracket_chars = re.compile(f'[{re.escape(open_char)}{re.escape(self.close_char)}]')
+        self.reset()
+
+    def reset(self):
+        self.chunks = []
+        self.length = 0
+        self.start = None
+        self.end = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> bool:
+        if self.end is not None:
+            return True
+
+        offset = self.length
+        self.chunks.append(text)
+        self.length += len(text)
+
+        # Text before the value is prose, so quotes in it aren't strings
+        pos = 0
+        if self.start is None:
+            pos = text.find(self.open_char)
+            if pos == -1:
+                return False
+            self.start = offset + pos
+            self.depth = 1
+            pos += 1
+
+        # An escape at the end of the last chunk applies to the first character of this one
+        if self.escaped and pos < len(text):
+            self.escaped = False
+            pos += 1
+
+        while pos < len(text):
+            if self.in_string:
+                match = STRING_SPECIAL_CHARS.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                if match.group() == "\"":
+                    self.in_string = False
+                elif pos < len(text):
+                    pos += 1
+                else:
+                    self.escaped = True
+            else:
+                match = self.value_special_chars.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    self.in_string = True
+                elif char == self.open_char:
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self.end = offset + pos
+                        return True
+        return False
+
+    def finish(self) -> bool:
+        """
+        Call once the text has ended.  If the first value never closed, like an open char in prose before the JSON,
+        fall back to the leftmost bracketed span that does close.  Like the recursive regex this replaced, the fallback
+        ignores strings, so it's one pass with a stack.
+        """
+        if self.end is not None or self.start is None:
+            return self.end is not None
+
+        text = "".join(self.chunks)
+        opened = []
+        best = None
+        for match in self.bracket_chars.finditer(text, self.start):
+            if match.group() == self.open_char:
+                opened.append(match.start())
+            elif opened:
+                value_start = opened.pop()
+                if best is None or value_start < best[0]:
+                    best = (value_start, match.end())
+                if not opened:
+                    # Anything after this starts further right
+                    break
+
+        if best is None:
+            return False
+        self.start, self.end = best
+        return True
+
+    @property
+    def value(self) -> str | None:
+        if self.end is None:
+            return None
+        return "".join(self.chunks)[self.start:self.end]
+
+
 def extract_only_json_dict(text: str) -> str:
     # Extract the first top-level JSON object
-    pattern = r'({(?:[^{}]|(?R))*})'
-    match = regex.search(pattern, text, regex.DOTALL)
-    if match:
-        return match.group(0)
+    extractor = JSONExtractor("{")
+    if extractor.feed(text) or extractor.finish():
+        return extractor.value
 
     return text
 
 
 def extract_only_json_list(text: str) -> str:
-    # Extract the first top-level JSON object
-    pattern = r'(\[(?:[^\[\]]|(?R))*\])'
-    match = regex.search(pattern, text, regex.DOTALL)
-    if match:
-        return match.group(0)
+    # Extract the first top-level JSON list
+    extractor = JSONExtractor("[")
+    if extractor.feed(text) or extractor.finish():
+        return extractor.value
 
     return text
 
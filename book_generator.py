@@ -8,11 +8,16 @@ from tqdm import tqdm
 
 from app.db.session import get_session
 from app.db.tables import * # Needed to avoid errors with table imports
-from app.course.tasks import create_course_concepts, create_course_outline, query_course_context
+from app.course.tasks import create_course_concepts, create_course_outline, create_course_plan, query_course_context
 from app.course.models import load_cached_course, Course
 from app.lesson.tasks import generate_lesson
 from app.lesson.output import render_components_to_output_markdown
+from app.llm.adaptors.oai import close_client_session
+from app.llm.example_store import set_example_model
 from app.llm.generators.outline import renumber_outline
+from app.llm.rate_limit import create_rate_limiter
+from app.llm.telemetry import flush_telemetry
+from app.metrics import create_metrics_aggregator, inc_counter, pushing_metrics, serve_metrics
 from app.settings import settings
 import json
 import os
@@ -72,16 +77,32 @@ async def generate_single_course(model, course_data: Dict | str, revision=1, out
     if cache_only:
         return None
 
+    inc_counter("courses_started_total", stage="course")
     if not outline:
         # Only generate outline if one was not passed in
-        concepts = await create_course_concepts(course_name, revision)
-        if concepts is None:
-            return
+        if settings.FUSED_COURSE_PLAN:
+            # Concepts and outline from one prompt
+            inc_counter("courses_started_total", stage="plan")
+            concepts, outline, queries = await create_course_plan(course_name, outline_items, revision)
+            if outline is None:
+                inc_counter("courses_failed_total", stage="plan")
+                return
+            inc_counter("courses_finished_total", stage="plan")
+        else:
+            inc_counter("courses_started_total", stage="concepts")
+            concepts = await create_course_concepts(course_name, revision)
+            if concepts is None:
+                inc_counter("courses_failed_total", stage="concepts")
+                return
+            inc_counter("courses_finished_total", stage="concepts")
 
-        outline, queries = await create_course_outline(course_name, concepts, outline_items, revision)
+            inc_counter("courses_started_total", stage="outline")
+            outline, queries = await create_course_outline(course_name, concepts, outline_items, revision)
 
-        if outline is None:
-            return
+            if outline is None:
+                inc_counter("courses_failed_total", stage="outline")
+                return
+            inc_counter("courses_finished_total", stage="outline")
 
         # Remove the intro if it exists
         if "intro" in outline[0].lower():
@@ -93,18 +114,24 @@ async def generate_single_course(model, course_data: Dict | str, revision=1, out
 
     context = None
     if queries is not None:
+        inc_counter("courses_started_total", stage="context")
         try:
             # Up to one retrieved passage per outline item
             # Remove numbers from outline for use in retrieval
             context_outline = [item.split(" ", 1)[-1] for item in outline]
             context = await query_course_context(model, queries, context_outline, course_name)
+            inc_counter("courses_finished_total", stage="context")
         except Exception as e:
+            inc_counter("courses_failed_total", stage="context")
             debug_print_trace()
             print(f"Error generating context for {course_name}: {e}")
 
+    inc_counter("courses_started_total", stage="lesson")
     components = await generate_lesson(course_name, components, outline, revision, research_notes=context)
     if components is None:
+        inc_counter("courses_failed_total", stage="lesson")
         return
+    inc_counter("courses_finished_total", stage="lesson")
 
     md = render_components_to_output_markdown(components)
 
@@ -120,21 +147,39 @@ async def generate_single_course(model, course_data: Dict | str, revision=1, out
         version=revision
     )
     await save_course(course)
+    inc_counter("courses_finished_total", stage="course")
 
     return course
 
 
 async def _process_course(model, topic, args):
+    # Few-shot examples are picked with the same model used for research notes
+    set_example_model(model)
     try:
         return await generate_single_course(model, topic, revision=args.revision, cache_only=args.cache_only)
     except Exception as e:
+        inc_counter("courses_failed_total", stage="course")
         debug_print_trace()
         print(f"Unhandled error generating course: {e}")
 
 
 async def _process_courses(model, courses, args):
     processes = [_process_course(model, course, args) for course in courses]
-    return await asyncio.gather(*processes)
+    try:
+        async with pushing_metrics():
+            return await asyncio.gather(*processes)
+    finally:
+        await close_client_session()
+        await flush_telemetry()
+
+
+async def _process_single_course(model, course, args):
+    try:
+        async with pushing_metrics():
+            return await _process_course(model, course, args)
+    finally:
+        await close_client_session()
+        await flush_telemetry()
 
 
 @ray.remote(num_cpus=settings.RAY_CORES_PER_WORKER)
@@ -149,7 +194,7 @@ def process_courses(model, courses, args):
 @ray.remote(num_cpus=settings.RAY_CORES_PER_WORKER)
 def process_course(model, course, args):
     try:
-        return asyncio.run(_process_course(model, course, args))
+        return asyncio.run(_process_single_course(model, course, args))
     except Exception as e:
         debug_print_trace()
         print(f"Unhandled error generating course: {e}")
@@ -182,6 +227,7 @@ if __name__ == "__main__":
     parser.add_argument("--extended-fields", action="store_true", default=False, help="Include extended fields in output")
     parser.add_argument("--revision", type=int, default=1, help="Revision number for the course.  Change this to avoid hitting cache if you want to regenerate a course.")
     parser.add_argument("--cache-only", action="store_true", default=False, help="Only use the cache, don't generate any new courses")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve prometheus metrics for the run on this port")
 
     args = parser.parse_args()
 
@@ -215,6 +261,14 @@ if __name__ == "__main__":
         dashboard_host=settings.RAY_DASHBOARD_HOST
     )
 
+    # Shared by all workers, so requests are admitted against one per-model budget
+    rate_limiter = create_rate_limiter()
+
+    if args.metrics_port is not None:
+        metrics_aggregator = create_metrics_aggregator()
+        serve_metrics(metrics_aggregator, args.metrics_port)
+        print(f"Serving metrics on http://{settings.METRICS_HOST}:{args.metrics_port}/metrics")
+
     model = SentenceTransformer("TaylorAI/gte-tiny")
     model_ref = ray.put(model)
 
@@ -0,0 +1,98 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import re
+import time
+
+from app.util import JSONExtractor, extract_only_json_dict
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+# The recursive pattern extract_only_json_dict used before JSONExtractor
+RECURSIVE_DICT_PATTERN = r'({(?:[^{}]|(?R))*})'
+
+
+def outline_json(items: int) -> str:
+    outline = [f"{i // 4 + 1}.{i % 4}. Section about {{braces}} and \"quotes\" number {i}" for i in range(items)]
+    return json.dumps({"outline": outline, "queries": ["a textbook", "lecture notes"]})
+
+
+def cases(size: int):
+    valid = outline_json(size // 60)
+    return {
+        "valid outline with prose around it": f"Here is the outline you asked for:\n{valid}\nLet me know if you want changes.",
+        "unclosed brace in prose before it": f"note {{unclosed ... {valid}",
+        "unclosed nesting": "{" * size,
+        "braces inside a string": '{"outline": "' + "}{" * (size // 2) + '"}',
+        "unbalanced braces and text": ("{ a " * (size // 4)) + "}",
+        "open chars between escaped quotes": '{"\\"' * (size // 4),
+        "cut off response": valid[:len(valid) // 2],
+    }
+
+
+def split_tokens(text: str):
+    return re.findall(r"\s*\S{1,4}|\s+", text)
+
+
+def time_call(fn, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def regex_extract(text: str, timeout: float):
+    try:
+        match = regex.search(RECURSIVE_DICT_PATTERN, text, regex.DOTALL, timeout=timeout)
+    except TimeoutError:
+        return None
+    return match.group(0) if match else text
+
+
+def streamed_chars(tokens) -> int:
+    # How much of the response streams in before the extractor can end the stream
+    extractor = JSONExtractor("{")
+    received = 0
+    for token in tokens:
+        received += len(token)
+        if extractor.feed(token):
+            break
+    return received
+
+
+def benchmark(size: int, repeat: int, timeout: float):
+    for name, text in cases(size).items():
+        print(f"{name} ({len(text):,} chars)")
+
+        seconds, result = time_call(lambda: extract_only_json_dict(text), repeat)
+        print(f"  scanner: {seconds * 1000:.3f} ms")
+
+        tokens = split_tokens(text)
+        seconds, received = time_call(lambda: streamed_chars(tokens), repeat)
+        print(f"  scanner, streamed in {len(tokens):,} tokens: {seconds * 1000:.3f} ms, stream could end after {received:,} chars")
+
+        if regex is None:
+            continue
+        seconds, regex_result = time_call(lambda: regex_extract(text, timeout), 1)
+        if regex_result is None:
+            print(f"  recursive regex: timed out after {timeout:.0f} s")
+        else:
+            same = "same result" if regex_result == result else "different result"
+            print(f"  recursive regex: {seconds * 1000:.3f} ms, {same}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON extraction from llm responses, including adversarial inputs.")
+    parser.add_argument("--size", type=int, default=20000, help="Approximate size of each input in characters")
+    parser.add_argument("--repeat", type=int, default=20, help="Times to run the scanner on each input")
+    parser.add_argument("--timeout", type=float, default=10, help="Seconds to give the recursive regex per input")
+    args = parser.parse_args()
+
+    if regex is None:
+        print("The regex package isn't installed, so only the scanner is timed.")
+    benchmark(args.size, args.repeat, args.timeout)
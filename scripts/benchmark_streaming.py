@@ -0,0 +1,65 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from app.llm.adaptors.oai import iter_sse_text
+from app.llm.llm import read_stream
+
+WORDS = ["the", " function", " returns", " a", " list", " of", " values", ".", "\n\n", " Python", " `dict`", " keys", " \"quoted\"", " 42", "\n"]
+
+
+def synthetic_lines(token_count: int, chat: bool):
+    random.seed(1)
+    lines = []
+    for i in range(token_count):
+        text = random.choice(WORDS)
+        if chat:
+            event = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0, "model": "bench", "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+        else:
+            event = {"id": "cmpl-bench", "object": "text_completion", "created": 0, "model": "bench", "choices": [{"index": 0, "text": text, "logprobs": None, "finish_reason": None}]}
+        lines.append(f"data: {json.dumps(event, separators=(',', ':'))}\n".encode("utf-8"))
+        lines.append(b"\n")
+    lines.append(b"data: [DONE]\n")
+    return lines
+
+
+async def replay(lines):
+    for line in lines:
+        yield line
+
+
+async def run_stream(lines, chat: bool, raw: bool) -> str:
+    return await read_stream(iter_sse_text(replay(lines), chat, raw), raw=raw)
+
+
+def benchmark(lines, chat: bool, raw: bool, streams: int, token_count: int):
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+
+    async def run_all():
+        return await asyncio.gather(*[run_stream(lines, chat, raw) for _ in range(streams)])
+
+    texts = asyncio.run(run_all())
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+    tokens = token_count * streams
+    mode = "raw bytes" if raw else "str"
+    print(f"{mode:>9}: {tokens / cpu:,.0f} tokens/s per core, {tokens / wall:,.0f} tokens/s wall, {len(texts[0])} chars per stream")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the streaming response path against a synthetic SSE stream.")
+    parser.add_argument("--tokens", type=int, default=6000, help="Tokens per stream")
+    parser.add_argument("--streams", type=int, default=100, help="Number of concurrent streams")
+    parser.add_argument("--completion", action="store_true", default=False, help="Use the completions format instead of chat")
+    args = parser.parse_args()
+
+    chat = not args.completion
+    lines = synthetic_lines(args.tokens, chat)
+    for raw in [False, True]:
+        benchmark(lines, chat, raw, args.streams, args.tokens)
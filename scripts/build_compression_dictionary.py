@@ -0,0 +1,57 @@
+import asyncio
+import glob
+import json
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func
+from sqlmodel import select
+
+from app.db.session import get_session
+from app.llm.models import Prompt
+from app.settings import settings
+
+import argparse
+
+# zlib only uses the last 32KB of the dictionary
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+
+def repo_samples():
+    samples = []
+    for path in sorted(glob.glob(os.path.join(settings.EXAMPLE_JSON_DIR, "*.json"))):
+        with open(path) as f:
+            samples.append(f.read())
+
+    # Every prompt starts with the templates, so they go last, where zlib can reach them with the shortest distances
+    for path in sorted(glob.glob(os.path.join(settings.PROMPT_TEMPLATE_DIR, "*.jinja"))):
+        with open(path) as f:
+            samples.append(f.read())
+    return samples
+
+
+async def db_samples(count: int):
+    async with get_session() as db:
+        query = await db.exec(select(Prompt.response).order_by(func.random()).limit(count))
+        return list(query.all())
+
+
+async def build_dictionary(out_path: str, sample_count: int):
+    samples = []
+    if sample_count > 0:
+        samples += await db_samples(sample_count)
+    samples += repo_samples()
+
+    dictionary = "\n".join(samples).encode("utf-8")[-MAX_DICTIONARY_SIZE:]
+    with open(out_path, "wb") as f:
+        f.write(dictionary)
+    print(f"Wrote {len(dictionary)} byte dictionary to {out_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a zlib dictionary for compressed database columns.  Save it under a new id in app/db/compression.py, never over an existing one.")
+    parser.add_argument("out_path", help="Where to write the dictionary")
+    parser.add_argument("--sample", type=int, default=0, help="Number of stored llm responses to sample from the database")
+    args = parser.parse_args()
+
+    asyncio.run(build_dictionary(args.out_path, args.sample))
@@ -8,17 +8,27 @@ from sqlmodel import select
 from app.course.models import Course
 from app.db.session import get_session
 from app.llm.models import Prompt
+from app.settings import settings
 
 import argparse
 
 
-async def clear_model_data(model: str, dry_run=False):
+def default_prompt_models(model: str):
+    # Prompts are stored under the model each prompt type uses, so a course's concepts, outline, and topic prompts are
+    # under LLM_INSTRUCT_TYPE
+    if model == settings.LLM_TYPE and settings.LLM_INSTRUCT_TYPE != model:
+        return [settings.LLM_INSTRUCT_TYPE]
+    return []
+
+
+async def clear_model_data(model: str, prompt_models=None, dry_run=False):
+    prompt_models = [model] + (prompt_models or [])
     async with get_session() as db:
-        query = await db.exec(select(Prompt).where(Prompt.model == model))
+        query = await db.exec(select(Prompt).where(Prompt.model.in_(prompt_models)))
         prompts = query.all()
-        print(f"Found {len(prompts)} prompts for model {model}.")
+        print(f"Found {len(prompts)} prompts for models {', '.join(prompt_models)}.")
         if not dry_run:
-            await db.exec(delete(Prompt).where(Prompt.model == model))
+            await db.exec(delete(Prompt).where(Prompt.model.in_(prompt_models)))
 
         query = await db.exec(select(Course).where(Course.model == model))
         courses = query.all()
@@ -31,10 +41,12 @@ async def clear_model_data(model: str, dry_run=False):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Remove all data related to a specific model.")
     parser.add_argument("model", help="model name")
+    parser.add_argument("--prompt-models", nargs="*", default=None, help="Other models to clear prompts for.  Defaults to LLM_INSTRUCT_TYPE when clearing LLM_TYPE.  Pass no models to only clear prompts for the model itself.  Prompts for the instruct model may be shared with courses for other models.")
     parser.add_argument("--dry-run", action="store_true", help="Don't actually delete anything.")
     args = parser.parse_args()
 
-    asyncio.run(clear_model_data(args.model, args.dry_run))
+    prompt_models = args.prompt_models if args.prompt_models is not None else default_prompt_models(args.model)
+    asyncio.run(clear_model_data(args.model, prompt_models, args.dry_run))
 
 
 
@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+
+from aiohttp import web
+
+WORDS = "the of and to in is that for it as with was on be by this are or from at an which have not they all were can more one their has had would been when there will".split()
+
+KNOWN_HEADERS = ["Table Of Contents\n", "Research Notes\n", "Next Sections: ", "Course\n\n"]
+
+
+def lorem(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+def input_section(prompt: str) -> str:
+    # The input always comes last, after the instructions and examples
+    return prompt.rsplit("\nInput\n", 1)[-1]
+
+
+def input_field(prompt: str, name: str) -> str:
+    match = re.search(rf"^{name}: (.*)$", input_section(prompt), re.MULTILINE)
+    return match.group(1).strip() if match else "a topic"
+
+
+def lesson_input_block(text: str, header: str) -> str:
+    if header not in text:
+        return ""
+    block = text.split(header, 1)[1]
+    for other in KNOWN_HEADERS:
+        if other != header and other in block:
+            block = block.split(other, 1)[0]
+    return block.strip()
+
+
+def concepts_response(prompt: str, rng: random.Random) -> str:
+    topic = input_field(prompt, "Topic")
+    concepts = [f"{topic} {rng.choice(WORDS)} {i + 1}" for i in range(5)]
+    return json.dumps({"feasible": True, "concepts": concepts})
+
+
+def outline_response(prompt: str, rng: random.Random) -> str:
+    match = re.search(r"at least (\d+) chapters", prompt)
+    chapter_count = int(match.group(1)) if match else 10
+    topic = input_field(prompt, "Topic")
+    outline = []
+    for chapter in range(1, chapter_count + 1):
+        outline.append(f"{chapter}. {lorem(rng, 3)[:-1]}")
+        for section in range(1, 4):
+            outline.append(f"{chapter}.{section}. {lorem(rng, 4)[:-1]}")
+    return json.dumps({"outline": outline, "queries": [f"{topic} textbook", f"{topic} lecture notes"]})
+
+
+def plan_response(prompt: str, rng: random.Random) -> str:
+    plan = json.loads(concepts_response(prompt, rng))
+    plan.update(json.loads(outline_response(prompt, rng)))
+    return json.dumps(plan)
+
+
+def toc_response(prompt: str, rng: random.Random) -> str:
+    topic = input_field(prompt, "Topic")
+    outline = json.loads(outline_response(prompt, rng))["outline"]
+    return json.dumps({"topic": topic, "outline": outline, "queries": [f"{topic} textbook"]})
+
+
+def list_response(prompt: str, rng: random.Random) -> str:
+    return json.dumps([lorem(rng, 5)[:-1] for _ in range(5)])
+
+
+def lesson_section(rng: random.Random) -> str:
+    return (
+        f"---text\n\n{lorem(rng, 120)}\n\n{lorem(rng, 80)}\n\n"
+        f"---example\n\n{lorem(rng, 60)}\n\n"
+        f"---exercise\n\nInstructions:\n\n{lorem(rng, 20)}\n\nSolution:\n\n{lorem(rng, 15)}\n\n"
+    )
+
+
+def lesson_response(prompt: str, rng: random.Random) -> str:
+    text = input_section(prompt)
+    outline = [o.strip() for o in lesson_input_block(text, "Table Of Contents\n").split("\n") if o.strip()]
+    course = lesson_input_block(text, "Course\n\n")
+    current = course.rsplit("---section", 1)[-1].strip()
+
+    # The prompt ends with the header of the section to write, so start with its content
+    start = outline.index(current) + 1 if current in outline else len(outline)
+    response = lesson_section(rng)
+    for item in outline[start:]:
+        response += f"---section\n\n{item}\n\n" + lesson_section(rng)
+    return response
+
+
+def canned_response(prompt: str) -> str:
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+    instructions = prompt.split("\nInput\n", 1)[0]
+    if "plan a detailed textbook" in instructions:
+        return plan_response(prompt, rng)
+    if "Identify if the topic is feasible" in instructions:
+        return concepts_response(prompt, rng)
+    if "develop a chapter and subchapter outline" in instructions:
+        return outline_response(prompt, rng)
+    if "cleaning up the draft outline" in instructions:
+        return toc_response(prompt, rng)
+    if "continue writing this detailed textbook" in instructions:
+        return lesson_response(prompt, rng)
+    if "JSON list" in instructions or "specific examples of items" in instructions:
+        return list_response(prompt, rng)
+    return "\n\n".join(lorem(rng, 80) for _ in range(4))
+
+
+def split_tokens(text: str):
+    return re.findall(r"\s*\S+|\s+", text)
+
+
+def apply_stops(text: str, stops) -> tuple[str, bool]:
+    if isinstance(stops, str):
+        stops = [stops]
+    positions = [text.find(stop) for stop in stops or [] if stop and stop in text]
+    if positions:
+        return text[:min(positions)], True
+    return text, False
+
+
+def event_data(chat: bool, model: str, text: str | None, finish_reason: str | None = None, role: bool = False) -> bytes:
+    if chat:
+        delta = {"role": "assistant"} if role else ({"content": text} if text is not None else {})
+        choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+        event = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [choice]}
+    else:
+        choice = {"index": 0, "text": text or "", "logprobs": None, "finish_reason": finish_reason}
+        event = {"id": "cmpl-mock", "object": "text_completion", "created": int(time.time()), "model": model, "choices": [choice]}
+    return f"data: {json.dumps(event)}\n\n".encode("utf-8")
+
+
+async def stream_completion(request: web.Request, chat: bool) -> web.StreamResponse:
+    config = request.app["config"]
+    body = await request.json()
+
+    if random.random() < config.rate_limit_rate:
+        return web.json_response(
+            {"error": {"message": "Rate limit reached for mock server. Please slow down.", "type": "requests"}},
+            status=429,
+            headers={"Retry-After": str(config.retry_after)},
+        )
+    if random.random() < config.error_rate:
+        return web.json_response({"error": {"message": "The mock server had an error. Please retry.", "type": "server_error"}}, status=500)
+
+    if chat:
+        prompt = body["messages"][-1]["content"]
+    else:
+        prompt = body["prompt"]
+    model = body.get("model", "mock")
+    max_tokens = body.get("max_tokens") or 2048
+
+    text, stopped = apply_stops(canned_response(prompt), body.get("stop"))
+    tokens = split_tokens(text)
+    finish_reason = "stop"
+    if len(tokens) > max_tokens:
+        tokens = tokens[:max_tokens]
+        finish_reason = "length"
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+
+    await asyncio.sleep(config.ttft)
+    if chat:
+        await response.write(event_data(chat, model, None, role=True))
+
+    # Sleep in small batches, since asyncio can't sleep accurately for a single token at high rates
+    batch = max(1, int(config.tps / 50))
+    for i in range(0, len(tokens), batch):
+        for token in tokens[i:i + batch]:
+            await response.write(event_data(chat, model, token))
+        await asyncio.sleep(batch / config.tps)
+
+    await response.write(event_data(chat, model, None, finish_reason=finish_reason))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    return await stream_completion(request, chat=True)
+
+
+async def completions(request: web.Request) -> web.StreamResponse:
+    return await stream_completion(request, chat=False)
+
+
+def create_app(config) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["config"] = config
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/completions", completions)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI-compatible streaming server for offline load testing.")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to bind to")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind to")
+    parser.add_argument("--ttft", type=float, default=0.5, help="Seconds before the first token")
+    parser.add_argument("--tps", type=float, default=50, help="Tokens per second per stream")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests that fail with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Fraction of requests that fail with a 429")
+    parser.add_argument("--retry-after", type=int, default=5, help="Retry-After seconds sent with 429s")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args), host=args.host, port=args.port)
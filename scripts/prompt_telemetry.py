@@ -0,0 +1,42 @@
+import asyncio
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datetime import datetime, timedelta, timezone
+
+from app.llm.telemetry import summarize_telemetry
+
+import argparse
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+
+async def print_telemetry(hours=None):
+    since = None
+    if hours is not None:
+        since = datetime.now(timezone.utc) - timedelta(hours=hours)
+
+    rows = await summarize_telemetry(since)
+    if not rows:
+        print("No telemetry recorded.")
+        return
+
+    keys = list(rows[0].keys())
+    table = [keys] + [[format_value(row[k]) for k in keys] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(keys))]
+    for line in table:
+        print("  ".join(value.ljust(width) for value, width in zip(line, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize llm call telemetry by prompt type and model.")
+    parser.add_argument("--hours", type=float, default=None, help="Only include calls from the last N hours.")
+    args = parser.parse_args()
+
+    asyncio.run(print_telemetry(args.hours))